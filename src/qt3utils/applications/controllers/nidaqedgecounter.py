@@ -1,4 +1,4 @@
-from typing import Generator
+from typing import Generator, Union
 import numpy as np
 import tkinter as tk
 import logging
@@ -36,6 +36,7 @@ class QT3ScopeNIDAQEdgeCounterController:
         self.data_generator.num_data_samples_per_batch = config_dict.get('num_data_samples_per_batch', self.data_generator.num_data_samples_per_batch)
         self.data_generator.read_write_timeout = config_dict.get('read_write_timeout', self.data_generator.read_write_timeout)
         self.data_generator.signal_counter = config_dict.get('signal_counter', self.data_generator.signal_counter)
+        self.data_generator.continuous_acquisition = config_dict.get('continuous_acquisition', self.data_generator.continuous_acquisition)
 
     @convert_nidaq_daqnotfounderror(module_logger)
     def start(self) -> None:
@@ -102,6 +103,14 @@ class QT3ScopeNIDAQEdgeCounterController:
         signal_counter_var = tk.StringVar(value=self.data_generator.signal_counter)
         tk.Entry(config_win, textvariable=signal_counter_var).grid(row=row, column=1)
 
+        row += 1
+        continuous_acquisition_var = tk.BooleanVar(value=self.data_generator.continuous_acquisition)
+        tk.Checkbutton(config_win,
+                       text="Continuous Acquisition",
+                       variable=continuous_acquisition_var,
+                       onvalue=True,
+                       offvalue=False).grid(row=row, column=0, columnspan=2, padx=10)
+
         # pack variables into a dictionary to pass to the _set_from_gui method
         gui_info = {
             'daq_name': daq_var,
@@ -111,6 +120,7 @@ class QT3ScopeNIDAQEdgeCounterController:
             'num_data_samples_per_batch': num_data_samples_per_batch_var,
             'read_write_timeout': read_write_timeout_var,
             'signal_counter': signal_counter_var,
+            'continuous_acquisition': continuous_acquisition_var,
         }
 
         # add a button to set the values and close the window
@@ -151,5 +161,5 @@ class QT3ScanNIDAQEdgeCounterController(QT3ScopeNIDAQEdgeCounterController):
     def sample_counts(self, num_batches: int) -> np.ndarray:
         return self.data_generator.sample_counts(num_batches)
 
-    def sample_count_rate(self, data_counts: np.ndarray) -> np.floating:
+    def sample_count_rate(self, data_counts: np.ndarray) -> Union[np.floating, np.ndarray]:
         return self.data_generator.sample_count_rate(data_counts)
@@ -1,11 +1,92 @@
 import logging
+import time
 import tkinter as tk
+import weakref
 from typing import Tuple, Optional, Union
 
 import nidaqmx
 import nipiezojenapy
 
 
+logger = logging.getLogger(__name__)
+
+
+class PiezoWriteTasks:
+    """
+    Moves a nipiezojenapy.PiezoControl stage through analog output tasks that are kept open
+    between moves, one per axis. nipiezojenapy.PiezoControl.go_to_position creates and closes a new
+    task for every move, which dominates the time of each step of a scan.
+
+    Only the public attributes of the PiezoControl are used: the device name and write channels
+    select the task, the scale and offset convert microns to volts as PiezoControl.go_to_position does,
+    and last_write_values is updated as it is, so that PiezoControl.get_current_position still returns
+    the last position written when no read channels are given.
+
+    The tasks are closed by close(), and otherwise when this object is garbage collected or the
+    interpreter exits.
+    """
+
+    def __init__(self, piezo_control: nipiezojenapy.PiezoControl):
+        self.piezo_control = piezo_control
+        # each entry maps an axis index to the (device, channel) its task was created for and the task.
+        # The dict is only ever modified in place, as the finalizer holds a reference to it.
+        self._tasks = {}
+        self._finalizer = weakref.finalize(self, _close_tasks, self._tasks)
+
+    def microns_to_volts(self, position: float, axis_index: int) -> float:
+        """
+        Returns the voltage that moves the axis to position, in microns.
+        """
+        return (position / self.piezo_control.scale_microns_per_volt[axis_index]
+                + self.piezo_control.zero_microns_volt_offset[axis_index])
+
+    def write(self, axis_index: int, position: float) -> None:
+        """
+        Writes the voltage for position, in microns, to the axis and records it as the last written position.
+        Does not check the position or wait for the stage to settle.
+        """
+        self._task(axis_index).write(self.microns_to_volts(position, axis_index))
+        self.piezo_control.last_write_values[axis_index] = position
+
+    def _task(self, axis_index: int) -> nidaqmx.Task:
+        """
+        Returns the open analog output task for the axis, creating it if the axis has no task yet or
+        if the DAQ device or the write channel of the axis have been changed since it was created.
+        """
+        key = (self.piezo_control.device_name, self.piezo_control.write_channels[axis_index])
+        task_key, task = self._tasks.get(axis_index, (None, None))
+        if task_key != key:
+            if task is not None:
+                task.close()
+                del self._tasks[axis_index]
+            task = nidaqmx.Task()
+            try:
+                task.ao_channels.add_ao_voltage_chan(key[0] + '/' + key[1])
+            except Exception:
+                task.close()
+                raise
+            self._tasks[axis_index] = (key, task)
+        return task
+
+    def close(self) -> None:
+        """
+        Closes the open tasks. Tasks are created again by the next write.
+        """
+        _close_tasks(self._tasks)
+
+
+def _close_tasks(tasks: dict) -> None:
+    """
+    Closes and removes all tasks of a PiezoWriteTasks task dict.
+    """
+    for _, task in tasks.values():
+        try:
+            task.close()
+        except (nidaqmx.errors.DaqError, nidaqmx._lib.DaqNotFoundError) as e:
+            logger.error(e)
+    tasks.clear()
+
+
 class QT3ScanNIDAQPositionController:
 
     def __init__(self, logger_level):
@@ -13,6 +94,7 @@ class QT3ScanNIDAQPositionController:
         self.logger.setLevel(logger_level)
 
         self.position_controller = nipiezojenapy.PiezoControl('Dev1')
+        self._write_tasks = PiezoWriteTasks(self.position_controller)
 
         self.last_config_dict = {}
 
@@ -31,10 +113,22 @@ class QT3ScanNIDAQPositionController:
         """
         This method is used to move the stage or objective to a position.
         """
+        self.position_controller.check_allowed_position(x, y, z)
         try:
-            self.position_controller.go_to_position(x, y, z)
+            for axis_index, position in enumerate((x, y, z)):
+                if position is not None:
+                    self._write_tasks.write(axis_index, float(position))
+            time.sleep(self.position_controller.settling_time_in_seconds)
         except (nidaqmx.errors.DaqError, nidaqmx._lib.DaqNotFoundError) as e:
             self.logger.error(e)
+            # the tasks are created again on the next move
+            self.close()
+
+    def close(self) -> None:
+        """
+        Closes the analog output tasks held open for moving the stage.
+        """
+        self._write_tasks.close()
 
     def get_current_position(self) -> Tuple[float, float, float]:
         try:
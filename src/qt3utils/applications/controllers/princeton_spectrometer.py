@@ -19,8 +19,8 @@ class QT3ScanPrincetonSpectrometerController:
         self.spectrometer_daq = princeton.PrincetonSpectrometerDataAcquisition(
             logger_level, self.spectrometer_config)
 
-        self.logger.debug('Initializing the Princeton Spectrometer')
-        self.spectrometer_config.open()
+        # Lightfield is started when the spectrometer is first used rather than here,
+        # as it takes several seconds to start.
         
         self.last_config_dict = {}
 
@@ -1,4 +1,4 @@
-from typing import Tuple, Optional, Generator
+from typing import Tuple, Optional, Generator, Union
 import tkinter as tk
 import logging
 import numpy as np
@@ -133,7 +133,7 @@ class QT3ScanRandomDataController(QT3ScopeRandomDataController):
     def sample_counts(self, num_batches: int) -> np.ndarray:
         return self.data_generator.sample_counts(num_batches)
 
-    def sample_count_rate(self, data_counts: np.ndarray) -> np.floating:
+    def sample_count_rate(self, data_counts: np.ndarray) -> Union[np.floating, np.ndarray]:
         return self.data_generator.sample_count_rate(data_counts)
 
 
@@ -166,18 +166,19 @@ class QT3ScanRandomSpectrometerDataController:
             self.nv_probability = 0.01
             self.background_counts = int(1e5)
             self.nv_brightness = int(1e6)
+            self.rng = np.random.default_rng()
 
         def acquire_step_and_glue(self) -> Tuple[np.ndarray, np.ndarray]:
             wavelengths = np.linspace(self.wave_start, self.wave_end, self.num_wavelength_bins, endpoint=False)
-            if np.random.random() > self.nv_probability:
-                spectrum = self.background_counts * np.random.random(self.num_wavelength_bins) / self.num_wavelength_bins
+            if self.rng.random() > self.nv_probability:
+                spectrum = self.rng.uniform(0, self.background_counts / self.num_wavelength_bins, size=self.num_wavelength_bins)
             else:
                 redux = 10
                 num_samples = int(self.nv_brightness / redux) # a little hack to make the sampling faster
-                sample_sideband = np.random.normal(690, 40, size=99 * num_samples // 100)
+                sample_sideband = self.rng.normal(690, 40, size=99 * num_samples // 100)
                 bins = np.linspace(self.wave_start, self.wave_end, self.num_wavelength_bins + 1, endpoint=True)
                 hist_sideband, _ = np.histogram(sample_sideband, bins=bins)
-                zpl_sample = np.random.normal(637, 2, size=1 * num_samples // 100)
+                zpl_sample = self.rng.normal(637, 2, size=1 * num_samples // 100)
                 zpl, _ = np.histogram(zpl_sample, bins=bins)
                 spectrum = (zpl + hist_sideband) * redux
             return spectrum, wavelengths
@@ -350,6 +351,12 @@ class QT3ScanDummyPositionController:
         """
         self.dummy_position.check_allowed_position(x, y, z)
 
+    def close(self) -> None:
+        """
+        Nothing to be done in this method. The dummy position controller holds no hardware resources.
+        """
+        pass
+
     def configure(self, config_dict: dict) -> None:
 
         # TODO -- modify the nipiezojenapy.BaseController class so that these are properties that can be set rather than
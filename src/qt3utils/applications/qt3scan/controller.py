@@ -1,9 +1,11 @@
+import functools
 import json
 import logging
 import pickle
 import time
 import tkinter as tk
-from typing import Tuple
+from threading import Thread
+from typing import Optional, Tuple
 
 import h5py
 import matplotlib
@@ -44,35 +46,55 @@ def weighted_mean_wavelength(wavelengths, spectra):
     if len(spectra.shape) != 3:
         raise ValueError("Input data must be a 3D numpy array.")
 
-    # Get number of dimensions (x, y, wavelengths)
-    x_dim, y_dim, wavelength_dim = spectra.shape
+    if spectra.shape[-1] == 0:
+        # Avoids error if filtered range is off the available wavelength limits
+        # and there are no data to be processed
+        return np.full(spectra.shape[:-1], np.nan)
 
-    # Initialize array for mean wavelengths
-    mean_wavelengths = np.zeros((x_dim, y_dim))
+    # The weights of each spectrum are its counts above the spectrum minimum. All spectra are
+    # processed at once: the weighted sums are a single matrix-vector product with the wavelengths.
+    weights = np.subtract(spectra, np.min(spectra, axis=-1, keepdims=True), dtype=np.float64)
+    total_weights = sum_over_last_axis(weights)
+    weighted_sums = weights @ np.asarray(wavelengths, dtype=np.float64)
 
-    # Loop over each x,y coordinate
-    for x in range(x_dim):
-        for y in range(y_dim):
-            # Extract spectrum for current coordinate
-            spectrum = spectra[x, y, :]
-
-            # Calculate weighted mean using counts as weights
-            try:
-                mean_wavelengths[x, y] = np.average(wavelengths, weights=spectrum - np.min(spectrum))
-            except ZeroDivisionError:
-                # Avoids error if filtered range is off the available wavelength limits
-                # and there are no data to be processed
-                mean_wavelengths[x, y] = np.nan
+    # a spectrum with no counts above its minimum has no weighted mean
+    mean_wavelengths = np.full(total_weights.shape, np.nan)
+    np.divide(weighted_sums, total_weights, out=mean_wavelengths, where=total_weights != 0)
 
     return mean_wavelengths
 
 
+def sum_over_last_axis(data: np.ndarray) -> np.ndarray:
+    """
+    Sums data over its last axis, such as the wavelength axis of the hyperspectral data.
+
+    Floating point data are summed as a matrix-vector product with a vector of ones,
+    which numpy passes to the BLAS library, and is faster than sum(axis=-1) for long spectra.
+    Other data types are summed with sum(axis=-1).
+    """
+    if np.issubdtype(data.dtype, np.floating):
+        return data @ np.ones(data.shape[-1], dtype=data.dtype)
+    return data.sum(axis=-1)
+
+
+def mean_over_last_axis(data: np.ndarray) -> np.ndarray:
+    """
+    Averages data over its last axis, using sum_over_last_axis.
+
+    Returns NaN for each spectrum if the last axis is empty, such as when the filtered
+    wavelength range contains no wavelengths.
+    """
+    if data.shape[-1] == 0:
+        return np.full(data.shape[:-1], np.nan)
+    return sum_over_last_axis(data) * (1. / data.shape[-1])
+
+
 # If we need to implement this for more than a single axis, we need to use the np.apply_over_axes method,
 # and also make sure to take into account the number of axes and the number of count axes (though, it should be 1?)
 # I guess if we have multidimensional axes (e.g. wavelength and number of frames), we need to aggregate that too.
 STANDARD_COUNT_AGGREGATION_METHODS = {
-    'Counts-Sum': lambda _, data: np.sum(data, axis=-1),
-    'Counts-Mean': lambda _, data: np.mean(data, axis=-1),
+    'Counts-Sum': lambda _, data: sum_over_last_axis(data),
+    'Counts-Mean': lambda _, data: mean_over_last_axis(data),
     'Counts-Max': lambda _, data: np.max(data, axis=-1),
     'Counts-Min': lambda _, data: np.min(data, axis=-1),
     'Axes-Weighted-Mean': lambda params, data: weighted_mean_wavelength(params, data),
@@ -102,6 +124,12 @@ class QT3ScanConfocalApplicationController:
         self.data_configs = {'DAQ': None, 'Scanner': None}
         self.data_saved_once = False
 
+    def wait_for_save(self, timeout: Optional[float] = None) -> bool:
+        """
+        Scans are saved synchronously, so no save is ever in progress.
+        """
+        return True
+
     @property
     def step_size(self) -> float:
         return self.daq_and_scanner.step_size
@@ -121,11 +149,11 @@ class QT3ScanConfocalApplicationController:
     @property
     def scanned_count_rate(self) -> np.ndarray:
         data_clock_rate = self.data_clock_rate if self.data_clock_rate is not None else np.nan
-        return np.array(self.daq_and_scanner.scanned_count_rate) - self.raw_bg_counts * data_clock_rate
+        return np.asarray(self.daq_and_scanner.scanned_count_rate) - self.raw_bg_counts * data_clock_rate
 
     @property
     def scanned_raw_counts(self) -> np.ndarray:
-        return np.array(self.daq_and_scanner.scanned_raw_counts) - self.raw_bg_counts
+        return np.asarray(self.daq_and_scanner.scanned_raw_counts) - self.raw_bg_counts
 
     @property
     def position_controller(self) -> QT3ScanPositionControllerInterface:
@@ -233,6 +261,7 @@ class QT3ScanConfocalApplicationController:
 
     def save_scan(self, afile_name) -> None:
         file_type = afile_name.split('.')[-1]
+        self.data_saved_once = False  # only set once the file has been written
 
         data = dict(
             scan_range=self.get_completed_scan_range(),
@@ -338,6 +367,7 @@ class QT3ScanHyperSpectralApplicationController:
 
         self.running = False
         self._current_y = 0
+        self._row = 0  # index of the row at current_y
         self._ymin = self.position_controller.minimum_allowed_position
         self._ymax = self.position_controller.maximum_allowed_position
         self._xmin = self.position_controller.minimum_allowed_position
@@ -348,12 +378,28 @@ class QT3ScanHyperSpectralApplicationController:
         self._raw_bg_counts = 0.
         self._filter_view_range = (-np.inf, np.inf)
         self._counts_aggregation_option = list(STANDARD_COUNT_AGGREGATION_METHODS.keys())[0]
+        self.aggregation_block_bytes = 256 * 1024  # rows of the hyperspectral data are aggregated in blocks of about this size
 
         self.hyper_spectral_raw_data = None  # is there way to create a "default numpy array", similar a 'default dict'?
+        self._hyper_spectral_buffer = None
         self.hyper_spectral_wavelengths = None
         self.data_clock_rate = None
         self.data_configs = {'DAQ': None, 'Scanner': None}
         self.data_saved_once = False
+        self._save_thread = None
+
+    def wait_for_save(self, timeout: Optional[float] = None) -> bool:
+        """
+        Waits up to timeout seconds, or until it is done if timeout is None, for a scan
+        that is being saved in a background thread to be written.
+        Returns True if no save is in progress anymore.
+        """
+        if self._save_thread is not None:
+            self._save_thread.join(timeout)
+            if self._save_thread.is_alive():
+                return False
+            self._save_thread = None
+        return True
 
     @property
     def step_size(self) -> float:
@@ -437,13 +483,23 @@ class QT3ScanHyperSpectralApplicationController:
 
     @property
     def scanned_raw_counts(self) -> np.ndarray:
-        if self.hyper_spectral_raw_data is not None:
+        if self.hyper_spectral_raw_data is not None and len(self.hyper_spectral_raw_data) > 0:
             wl_min, wl_max = min(self.filter_view_range), max(self.filter_view_range)
             wls = self.hyper_spectral_wavelengths
-            data_in_range = np.float64(self.hyper_spectral_raw_data[:, :, (wls >= wl_min) & (wls <= wl_max)])
-            data_in_range -= self.raw_bg_counts
-            wls_in_range = wls[(wls >= wl_min) & (wls <= wl_max)]
-            return self.counts_aggregation_method(wls_in_range, data_in_range)
+            in_range = (wls >= wl_min) & (wls <= wl_max)
+            wls_in_range = wls[in_range]
+
+            # the rows are filtered, background subtracted and aggregated a block at a time, so that each
+            # block stays in the CPU cache rather than streaming a full float64 copy of the data through memory.
+            raw_data = self.hyper_spectral_raw_data
+            row_bytes = raw_data.shape[1] * len(wls_in_range) * np.dtype(np.float64).itemsize
+            rows_per_block = max(1, self.aggregation_block_bytes // max(row_bytes, 1))
+            aggregated_blocks = []
+            for start in range(0, len(raw_data), rows_per_block):
+                data_in_range = np.float64(raw_data[start:start + rows_per_block, :, in_range])
+                data_in_range -= self.raw_bg_counts
+                aggregated_blocks.append(self.counts_aggregation_method(wls_in_range, data_in_range))
+            return np.concatenate(aggregated_blocks)
         else:
             return np.array([])
 
@@ -504,13 +560,16 @@ class QT3ScanHyperSpectralApplicationController:
         """
         Resets internal data structure. NB: this blows away any previously stored data.
         """
+        self.wait_for_save()
         self.hyper_spectral_raw_data = None
+        self._hyper_spectral_buffer = None
         self.hyper_spectral_wavelengths = None
         self.data_clock_rate = None
         self.data_configs = {'DAQ': None, 'Scanner': None}
         self.data_saved_once = False
 
     def set_to_starting_position(self) -> None:
+        self._row = 0
         self._current_y = self.ymin
         self.position_controller.go_to_position(x=self.xmin, y=self.ymin)
 
@@ -518,7 +577,7 @@ class QT3ScanHyperSpectralApplicationController:
         if self.running is False:  # this allows external process to stop scan
             return False
 
-        if self.current_y <= self.ymax:  # stops scan when reaches final position
+        if self._row < self._num_rows():  # stops scan when reaches final position
             return True
         else:
             self.running = False
@@ -527,27 +586,43 @@ class QT3ScanHyperSpectralApplicationController:
     def scan_x(self):
         """
         Scans the x axis from xmin to xmax in steps of step_size.
+
+        Every other row is scanned in the reverse direction, from xmax to xmin (a serpentine raster),
+        so that the stage does not travel back to xmin between rows. The data are always stored
+        in order of increasing x.
         """
+        reverse = self.hyper_spectral_raw_data is not None and len(self.hyper_spectral_raw_data) % 2 == 1
         raw_counts_for_axis, wavelengths = (
-            self.scan_axis('x', self.xmin, self.xmax, self.step_size)
+            self.scan_axis('x', self.xmin, self.xmax, self.step_size, reverse=reverse)
         )
         # raw_counts_for_axis is of shape (N steps, M spectrum size)
         # wavelengths is of shape (M spectrum size,)
         assert len(wavelengths) == raw_counts_for_axis.shape[-1]
 
-        # rehape raw_counts to
-        # (1, N, M)
-        raw_counts_for_axis = raw_counts_for_axis.reshape(1, len(raw_counts_for_axis), -1)
-
         if self.hyper_spectral_raw_data is None:
-            self.hyper_spectral_raw_data = raw_counts_for_axis
-            self.logger.debug(f'Creating new hyperspectral array of shape: {self.hyper_spectral_raw_data.shape}')
+            n_rows = 0
         else:
+            n_rows = len(self.hyper_spectral_raw_data)
             if self.hyper_spectral_raw_data.shape[-1] != raw_counts_for_axis.shape[-1]:
                 raise QT3Error("Inconsistent spectrum size obtained during scan_x! Check your hardware."
                                f"expected shape[-1] {self.hyper_spectral_raw_data.shape[-1]}. found {raw_counts_for_axis.shape[-1]}")
 
-            self.hyper_spectral_raw_data = np.vstack((self.hyper_spectral_raw_data, raw_counts_for_axis))
+        # the rows are written into a buffer allocated for the whole scan, rather than stacked onto a
+        # copy of all previous rows after each line. hyper_spectral_raw_data is a view of the rows scanned so far.
+        # the buffer keeps the spectrometer's dtype, so that integer counts are saved exactly.
+        buffer = self._hyper_spectral_buffer
+        if (buffer is None or len(buffer) <= n_rows or buffer.shape[1:] != raw_counts_for_axis.shape
+                or not np.can_cast(raw_counts_for_axis.dtype, buffer.dtype)):
+            expected_rows = len(qt3utils.datagenerators.piezoscanner.scan_positions(self.ymin, self.ymax, self.step_size))
+            dtype = raw_counts_for_axis.dtype if n_rows == 0 else np.result_type(self.hyper_spectral_raw_data, raw_counts_for_axis)
+            buffer = np.empty((max(expected_rows, 2 * n_rows, 1),) + raw_counts_for_axis.shape, dtype=dtype)
+            if n_rows > 0:
+                buffer[:n_rows] = self.hyper_spectral_raw_data
+            self._hyper_spectral_buffer = buffer
+            self.logger.debug(f'Creating new hyperspectral array of shape: {buffer.shape}')
+
+        buffer[n_rows] = raw_counts_for_axis
+        self.hyper_spectral_raw_data = buffer[:n_rows + 1]
 
         if self.hyper_spectral_wavelengths is None:
             self.hyper_spectral_wavelengths = wavelengths
@@ -555,36 +630,53 @@ class QT3ScanHyperSpectralApplicationController:
         if np.array_equal(self.hyper_spectral_wavelengths, wavelengths) is False:
             raise QT3Error("Inconsistent wavelength array obtained during scan_x! Check your hardware.")
 
-    def scan_axis(self, axis, min, max, step_size) -> Tuple[np.ndarray, np.ndarray]:
+    def scan_axis(self, axis, min, max, step_size, reverse=False, positions=None) -> Tuple[np.ndarray, np.ndarray]:
         """
         Moves the microscope along the specified axis from min to max in steps of step_size.
+        The positions may be given directly, in which case min, max and step_size are not used
+        to compute them.
+        If reverse is True, the positions are visited from max to min, but the returned
+        spectra are still ordered from min to max.
         Returns a tuple of two numpy arrays
-        The first numpy array is the raw spectrum from the scan in the shape
+        The first numpy array is the raw spectrum from the scan, with the spectrometer's dtype, in the shape
         (N, M) where N is the number of positions along the axis and M
         is the size of the spectrum
         The second numpy array is an array of wavelength values for the spectrum of shape (M,)
         """
-        spectrums_in_scan = []
+        if positions is None:
+            positions = qt3utils.datagenerators.piezoscanner.scan_positions(min, max, step_size)
+        go_to_position = self.position_controller.go_to_position
+        sample_spectrum = self.daq_controller.sample_spectrum
 
-        # we use these to check the returned spectrum
+        # the spectrum array is allocated once the first spectrum has been measured, and
+        # we use it and the first wavelength array to check the returned spectrum
         # and wavelength array for consistency.
         # we also currently do not support the
         # values of the wavelengths changing for each position
         # that is, the spectrometer must scan over the same set of wavelengths each time.
+        spectrums_in_scan = None
         wavelength_array = None
-        initial_spectrum_size = None
 
-        self.position_controller.go_to_position(**{axis: min})
+        indices = range(len(positions) - 1, -1, -1) if reverse else range(len(positions))
+        if len(positions) > 0:
+            go_to_position(**{axis: positions[indices[0]]})
         time.sleep(self.raster_line_pause)
 
-        for val in np.arange(min, max + step_size, step_size):
-            self.position_controller.go_to_position(**{axis: val})
-            measured_spectrum, measured_wavelengths = self.daq_controller.sample_spectrum()
-
-            if initial_spectrum_size is None:
-                initial_spectrum_size = len(measured_spectrum)
-            if wavelength_array is None:
+        # the first position was moved to before the pause. Each move is completed before the next
+        # spectrum is acquired, since moving the stage during an exposure would smear the spectrum.
+        for k, i in enumerate(indices):
+            if k > 0:
+                go_to_position(**{axis: positions[i]})
+            measured_spectrum, measured_wavelengths = sample_spectrum()
+
+            if spectrums_in_scan is None:
+                # spectra are stored with the spectrometer's dtype, so that integer counts, such as the
+                # uint64 step-and-glue column sums, are kept exactly. They are converted to float64 when
+                # they are aggregated.
+                spectrums_in_scan = np.empty((len(positions), len(measured_spectrum)),
+                                             dtype=np.asarray(measured_spectrum).dtype)
                 wavelength_array = measured_wavelengths
+            initial_spectrum_size = spectrums_in_scan.shape[1]
 
             if initial_spectrum_size != len(measured_spectrum):
                 raise QT3Error("Inconsistent spectrum size obtained during scan! Check your hardware.")
@@ -595,17 +687,26 @@ class QT3ScanHyperSpectralApplicationController:
                     "Inconsistent wavelength array and spectrum size obtained during scan! Check your hardware.")
             if np.array_equal(wavelength_array, measured_wavelengths) is False:
                 raise QT3Error("Inconsistent wavelength array obtained during scan! Check your hardware.")
-            spectrums_in_scan.append(measured_spectrum)
+            spectrums_in_scan[i] = measured_spectrum
 
-        return np.array(spectrums_in_scan), wavelength_array
+        if spectrums_in_scan is None:
+            return np.array([]), wavelength_array
+        return spectrums_in_scan, wavelength_array
+
+    def _num_rows(self) -> int:
+        return len(qt3utils.datagenerators.piezoscanner.scan_positions(self.ymin, self.ymax, self.step_size))
 
     def move_y(self) -> None:
-        if self.current_y <= self.ymax:
-            self._current_y += self.step_size
-        try:
-            self.position_controller.go_to_position(y=self.current_y)
-        except ValueError as e:
-            self.logger.info(f'move y: out of range\n\n{e}')
+        # current_y is computed from the row index rather than accumulated, see CounterAndScanner.move_y
+        num_rows = self._num_rows()
+        if self._row < num_rows:
+            self._row += 1
+            self._current_y = self.ymin + self._row * self.step_size
+        if self._row < num_rows:
+            try:
+                self.position_controller.go_to_position(y=min(self.current_y, self.ymax))
+            except ValueError as e:
+                self.logger.info(f'move y: out of range\n\n{e}')
 
     def optimize_position(
             self, axis: str,
@@ -638,40 +739,45 @@ class QT3ScanHyperSpectralApplicationController:
 
         """
         import scipy
-        def gauss(x, *p):
-            C, mu, sigma, offset = p
-            return C * np.exp(-(x - mu) ** 2 / (2. * sigma ** 2)) + offset
+        gauss = qt3utils.datagenerators.piezoscanner.gauss
+        gauss_jac = qt3utils.datagenerators.piezoscanner.gauss_jac
 
         min_val = central - range
         max_val = central + range
         if self.position_controller:
-            min_val = np.max([min_val, self.position_controller.minimum_allowed_position])
-            max_val = np.min([max_val, self.position_controller.maximum_allowed_position])
+            min_val = max(min_val, self.position_controller.minimum_allowed_position)
+            max_val = min(max_val, self.position_controller.maximum_allowed_position)
+
+        # the same positions are scanned and fit, so their lengths always match
+        axis_vals = qt3utils.datagenerators.piezoscanner.scan_positions(min_val, max_val, step_size)
 
         self.start()
-        raw_data, wavelengths = self.scan_axis(axis, min_val, max_val, step_size)
+        raw_data, wavelengths = self.scan_axis(axis, min_val, max_val, step_size, positions=axis_vals)
         self.stop()
         self.post_stop()
-        axis_vals = np.arange(min_val, max_val + step_size, step_size)
 
         wl_min, wl_max = min(self.filter_view_range), max(self.filter_view_range)
-        raw_data_in_range = raw_data[:, (wavelengths >= wl_min) & (wavelengths <= wl_max)]
+        raw_data_in_range = np.float64(raw_data[:, (wavelengths >= wl_min) & (wavelengths <= wl_max)])
         raw_data_in_range -= self.raw_bg_counts
         wls_in_range = wavelengths[(wavelengths >= wl_min) & (wavelengths <= wl_max)]
         count_rates = self.counts_aggregation_method(wls_in_range, raw_data_in_range)
         if not self.counts_aggregation_option.startswith('Axes'):
             count_rates *= self.data_clock_rate
 
-        optimal_position = axis_vals[np.argmax(count_rates)]
+        # the brightest position is both the fallback result and the initial guess of mu, and its
+        # count rate is the initial guess of C, so the data are searched for the maximum only once
+        i_max = np.argmax(count_rates)
+        optimal_position = axis_vals[i_max]
         coeff = None
-        params = [np.max(count_rates), optimal_position, 1.0, np.min(count_rates)]
+        params = [count_rates[i_max], optimal_position, 1.0, np.min(count_rates)]
         bounds = ((0, -np.inf, 0, 0), (np.inf, np.inf, np.inf, np.inf))
         try:
-            coeff, var_matrix = scipy.optimize.curve_fit(gauss, axis_vals, count_rates, p0=params, bounds=bounds)
-            optimal_position = coeff[1]
+            # the model reuses one output array, see CounterAndScanner.optimize_position
+            model = functools.partial(gauss, out=np.empty(len(axis_vals)))
+            coeff, var_matrix = scipy.optimize.curve_fit(model, axis_vals, count_rates, p0=params, bounds=bounds,
+                                                         jac=gauss_jac)
             # ensure that the optimal position is within the scan range
-            optimal_position = np.max([min_val, optimal_position])
-            optimal_position = np.min([max_val, optimal_position])
+            optimal_position = min(max_val, max(min_val, coeff[1]))
         except RuntimeError as e:
             self.logger.warning(e)
 
@@ -698,6 +804,8 @@ class QT3ScanHyperSpectralApplicationController:
 
     def save_scan(self, afile_name) -> None:
         file_type = afile_name.split('.')[-1]
+        self.wait_for_save()  # saves are serialized, so a file is never written by two threads
+        self.data_saved_once = False  # only set once the file has been written
 
         data = dict(
             wavelengths=self.hyper_spectral_wavelengths,
@@ -723,21 +831,43 @@ class QT3ScanHyperSpectralApplicationController:
         elif file_type == 'h5':
             with h5py.File(afile_name, 'w') as h5file:
                 for key, value in data.items():
-                    if key not in ['daq_config', 'scanner_config']:
+                    if key == 'hyperspectral_image' and value is not None and value.ndim == 3 and value.size > 0:
+                        # one chunk per spectrum, so that readers can load the spectrum at a single
+                        # scan position without reading the whole hyperspectral image
+                        h5file.create_dataset(key, data=value, chunks=(1, 1, value.shape[-1]))
+                    elif key not in ['daq_config', 'scanner_config']:
                         h5file.create_dataset(key, data=value)
                     else:
                         h5file.attrs[key] = json.dumps(value)
 
         elif file_type == 'pkl':
-            with open(afile_name, 'wb') as f:
-                pickle.dump(data, f)
+            # the file is written in a background thread, so that the application is not blocked
+            # while a large hyperspectral image is serialized. data_saved_once is set by the thread
+            # once the file has been written. Use wait_for_save to wait for it.
+            self._save_thread = Thread(target=self._write_pickle, args=(afile_name, data))
+            self._save_thread.start()
+            return
         else:
             return
 
         self.data_saved_once = True
 
+    def _write_pickle(self, afile_name, data) -> None:
+        """
+        Pickles data to afile_name and sets data_saved_once if it succeeds.
+        Pickle protocol 5 writes the numpy arrays directly from their buffers.
+        """
+        try:
+            with open(afile_name, 'wb') as f:
+                pickle.dump(data, f, protocol=5)
+        except Exception as e:
+            self.logger.error(f'Failed to save scan to {afile_name}: {e}')
+        else:
+            self.data_saved_once = True
+
     def load_scan(self, afile_name):
         file_type = afile_name.split('.')[-1]
+        self.wait_for_save()  # the file may be the one that is being written
 
         if file_type == 'npy':
             logging.error('Filetype "npy" is not supported for loading scans.')
@@ -763,6 +893,7 @@ class QT3ScanHyperSpectralApplicationController:
 
         self.hyper_spectral_wavelengths = data_dict.get('wavelengths', None)
         self.hyper_spectral_raw_data = data_dict.get('hyperspectral_image', None)
+        self._hyper_spectral_buffer = None
         self._xmin, self._xmax, self._ymin, self._current_y = \
             data_dict.get('scan_range', (
                 self.position_controller.minimum_allowed_position,
@@ -1,5 +1,5 @@
 import tkinter as Tk
-from typing import Tuple, Optional, Protocol, runtime_checkable
+from typing import Tuple, Optional, Protocol, Union, runtime_checkable
 
 import numpy as np
 from matplotlib.backend_bases import MouseEvent
@@ -47,6 +47,13 @@ class QT3ScanPositionControllerInterface(Protocol):
         """
         pass
 
+    def close(self) -> None:
+        """
+        Implementations should release any hardware resources held open between moves.
+        This is called when the application is closed.
+        """
+        pass
+
     def configure(self, config_dict: dict) -> None:
         """
         This method is used to configure the controller.
@@ -121,15 +128,21 @@ class QT3ScanCounterDAQControllerInterface(QT3ScanDAQControllerInterface, Protoc
         """
         pass
 
-    def sample_count_rate(self, data_counts: np.ndarray) -> np.floating:
+    def sample_count_rate(self, data_counts: np.ndarray) -> Union[np.floating, np.ndarray]:
         """
-        Implementations should return a numpy floating point number
+        Implementations should return a numpy floating point number, or a numpy array
+        of them when data_counts has leading dimensions.
 
         The returned value should be the count rate in counts per second.
         The input of data_counts should be of shape (1, 2) where the first
         element is the number of counts, the second element is the number of clock ticks.
         Using the clock_rate, this method should compute the count rate, which is
         counts / (clock_ticks / clock_rate).
+
+        data_counts may also be the results of sample_counts stacked along a scan line,
+        of shape (N, 1, 2), in which case a numpy array of N count rates should be returned.
+        CounterAndScanner converts the counts of a whole scan line with a single call.
+        For example, see daqsamplers.RateCounterBase.sample_count_rate().
         """
         pass
 
@@ -321,6 +334,16 @@ class QT3ScanApplicationControllerInterface(Protocol):
         """
         pass
 
+    def wait_for_save(self, timeout: Optional[float] = None) -> bool:
+        """
+        Implementations that write files in the background should wait up to timeout seconds,
+        or until the write is done if timeout is None, and return True if no save is in progress anymore.
+        Implementations that save synchronously should return True.
+
+        data_saved_once should only be True once the data has been written successfully.
+        """
+        pass
+
     def allowed_file_save_formats(self) -> list:
         """
         Returns a list of tuples of the allowed file save formats
@@ -386,6 +386,34 @@ class SidePanel:
         row += 1
         tk.Label(frame, text='', ).grid(row=row, column=0, columnspan=3, pady=10)
 
+        # widgets that are disabled while a scan or an optimization is running.
+        # the list is built once so that toggling them does not look up each widget.
+        self.scan_widgets = [
+            self.startButton,
+            self.go_to_z_button,
+            self.gotoButton,
+            self.saveScanButton,
+            self.popOutScanButton,
+            self.loadScanButton,
+            self.optimize_x_button,
+            self.optimize_y_button,
+            self.optimize_z_button,
+            self.controller_menu,
+            self.daq_config_button,
+            self.position_controller_config_button,
+            self.config_from_yaml_button,
+        ]
+
+    def set_scan_widgets_state(self, state: str, include_stop_button: bool = False) -> None:
+        """
+        Sets the state (tk.NORMAL or tk.DISABLED) of the widgets that are disabled while scanning.
+        The stop button is included if include_stop_button is True, as is done during optimization.
+        """
+        for widget in self.scan_widgets:
+            widget.config(state=state)
+        if include_stop_button:
+            self.stopButton.config(state=state)
+
     def update_go_to_position(self,
                               x: Optional[float] = None,
                               y: Optional[float] = None,
@@ -533,6 +561,7 @@ class MainTkApplication:
 
         self.root_window.protocol("WM_DELETE_WINDOW", self.on_closing)
         self.scan_thread = None
+        self._pending_save_file = None  # file that is being saved in the background
 
         self.optimized_position = {'x': 0, 'y': 0, 'z': -1}
         self.optimized_position['z'] = self.application_controller.position_controller.get_current_position()[2]
@@ -584,6 +613,7 @@ class MainTkApplication:
         """
         # check if last scan was saved
         if hasattr(self, 'application_controller'):
+            self._finish_pending_save()
             if self.application_controller.data_saved_once is False:
                 stored_data_shape = np.prod(np.shape(self.application_controller.scanned_count_rate))
                 data_shape_product = np.prod(stored_data_shape)
@@ -809,26 +839,13 @@ class MainTkApplication:
             logger.warning('Check your configuration! One or more of your devices were not properly initialized.')
 
         finally:
-            self.view.sidepanel.startButton.config(state=tk.NORMAL)
-            self.view.sidepanel.go_to_z_button.config(state=tk.NORMAL)
-            self.view.sidepanel.gotoButton.config(state=tk.NORMAL)
-            self.view.sidepanel.saveScanButton.config(state=tk.NORMAL)
-            self.view.sidepanel.popOutScanButton.config(state=tk.NORMAL)
-            self.view.sidepanel.loadScanButton.config(state=tk.NORMAL)
-
-            self.view.sidepanel.optimize_x_button.config(state=tk.NORMAL)
-            self.view.sidepanel.optimize_y_button.config(state=tk.NORMAL)
-            self.view.sidepanel.optimize_z_button.config(state=tk.NORMAL)
-
-            self.view.sidepanel.controller_menu.config(state=tk.NORMAL)
-            self.view.sidepanel.daq_config_button.config(state=tk.NORMAL)
-            self.view.sidepanel.position_controller_config_button.config(state=tk.NORMAL)
-            self.view.sidepanel.config_from_yaml_button.config(state=tk.NORMAL)
+            self.view.sidepanel.set_scan_widgets_state(tk.NORMAL)
 
             if self.view.sidepanel.gotoAfterScanBoolVar.get():
                 self.go_to_position()
 
     def start_scan(self) -> None:
+        self._finish_pending_save()
         if self.application_controller.data_saved_once is False:
             stored_data_shape = np.prod(np.shape(self.application_controller.scanned_count_rate))
             data_shape_product = np.prod(stored_data_shape)
@@ -839,21 +856,7 @@ class MainTkApplication:
                 if not proceed:
                     return
 
-        self.view.sidepanel.startButton.config(state=tk.DISABLED)
-        self.view.sidepanel.go_to_z_button.config(state=tk.DISABLED)
-        self.view.sidepanel.gotoButton.config(state=tk.DISABLED)
-        self.view.sidepanel.saveScanButton.config(state=tk.DISABLED)
-        self.view.sidepanel.popOutScanButton.config(state=tk.DISABLED)
-        self.view.sidepanel.loadScanButton.config(state=tk.DISABLED)
-
-        self.view.sidepanel.optimize_x_button.config(state=tk.DISABLED)
-        self.view.sidepanel.optimize_y_button.config(state=tk.DISABLED)
-        self.view.sidepanel.optimize_z_button.config(state=tk.DISABLED)
-
-        self.view.sidepanel.controller_menu.config(state=tk.DISABLED)
-        self.view.sidepanel.daq_config_button.config(state=tk.DISABLED)
-        self.view.sidepanel.position_controller_config_button.config(state=tk.DISABLED)
-        self.view.sidepanel.config_from_yaml_button.config(state=tk.DISABLED)
+        self.view.sidepanel.set_scan_widgets_state(tk.DISABLED)
 
         # clear the figure
         self.view.scan_view.reset()
@@ -879,7 +882,34 @@ class MainTkApplication:
             return  # selection was canceled.
 
         logger.info(f'Saving data to {afile}')
+        self._finish_pending_save()
         self.application_controller.save_scan(afile)
+        self._pending_save_file = afile
+        self._poll_pending_save()
+
+    def _poll_pending_save(self) -> None:
+        """
+        Checks, from the Tk event loop, whether a scan that is saved in the background has been written.
+        """
+        if self._pending_save_file is None:
+            return
+        if self.application_controller.wait_for_save(timeout=0):
+            self._finish_pending_save()
+        else:
+            self.root_window.after(100, self._poll_pending_save)
+
+    def _finish_pending_save(self) -> None:
+        """
+        Waits for the last save to be written and tells the user if it failed.
+        This is called before anything that could replace the scan data or read the saved file.
+        """
+        if self._pending_save_file is None:
+            return
+        afile, self._pending_save_file = self._pending_save_file, None
+        self.application_controller.wait_for_save()
+        if self.application_controller.data_saved_once is False:
+            messagebox.showerror("ERROR: Scan NOT SAVED",
+                                 f"The scan could not be saved to {afile}. See the log for details.")
 
     def load_scan(self):
         afile = tk.filedialog.askopenfilename(filetypes=self.application_controller.allowed_file_save_formats(),
@@ -888,6 +918,7 @@ class MainTkApplication:
             return  # selection was canceled.
 
         logger.info(f'Loading data from {afile}')
+        self._finish_pending_save()
         self.application_controller.load_scan(afile)
 
         if hasattr(self.application_controller, 'filter_view_range'):
@@ -934,22 +965,7 @@ class MainTkApplication:
             logger.info(e)
 
         finally:
-            self.view.sidepanel.startButton.config(state=tk.NORMAL)
-            self.view.sidepanel.stopButton.config(state=tk.NORMAL)
-            self.view.sidepanel.go_to_z_button.config(state=tk.NORMAL)
-            self.view.sidepanel.gotoButton.config(state=tk.NORMAL)
-            self.view.sidepanel.saveScanButton.config(state=tk.NORMAL)
-            self.view.sidepanel.popOutScanButton.config(state=tk.NORMAL)
-            self.view.sidepanel.loadScanButton.config(state=tk.NORMAL)
-
-            self.view.sidepanel.optimize_x_button.config(state=tk.NORMAL)
-            self.view.sidepanel.optimize_y_button.config(state=tk.NORMAL)
-            self.view.sidepanel.optimize_z_button.config(state=tk.NORMAL)
-
-            self.view.sidepanel.controller_menu.config(state=tk.NORMAL)
-            self.view.sidepanel.daq_config_button.config(state=tk.NORMAL)
-            self.view.sidepanel.position_controller_config_button.config(state=tk.NORMAL)
-            self.view.sidepanel.config_from_yaml_button.config(state=tk.NORMAL)
+            self.view.sidepanel.set_scan_widgets_state(tk.NORMAL, include_stop_button=True)
 
     def optimize(self, axis: str) -> None:
 
@@ -957,32 +973,22 @@ class MainTkApplication:
         opt_step_size = float(self.view.sidepanel.optimize_step_size_entry.get())
         old_optimized_value = self.optimized_position[axis]
 
-        self.view.sidepanel.startButton.config(state=tk.DISABLED)
-        self.view.sidepanel.stopButton.config(state=tk.DISABLED)
-        self.view.sidepanel.go_to_z_button.config(state=tk.DISABLED)
-        self.view.sidepanel.gotoButton.config(state=tk.DISABLED)
-        self.view.sidepanel.saveScanButton.config(state=tk.DISABLED)
-        self.view.sidepanel.popOutScanButton.config(state=tk.DISABLED)
-        self.view.sidepanel.loadScanButton.config(state=tk.DISABLED)
-
-        self.view.sidepanel.optimize_x_button.config(state=tk.DISABLED)
-        self.view.sidepanel.optimize_y_button.config(state=tk.DISABLED)
-        self.view.sidepanel.optimize_z_button.config(state=tk.DISABLED)
-
-        self.view.sidepanel.controller_menu.config(state=tk.DISABLED)
-        self.view.sidepanel.daq_config_button.config(state=tk.DISABLED)
-        self.view.sidepanel.position_controller_config_button.config(state=tk.DISABLED)
-        self.view.sidepanel.config_from_yaml_button.config(state=tk.DISABLED)
+        self.view.sidepanel.set_scan_widgets_state(tk.DISABLED, include_stop_button=True)
 
         self.optimize_thread = Thread(target=self._optimize_thread_function,
                                       args=(axis, old_optimized_value, opt_range, opt_step_size))
         self.optimize_thread.start()
 
     def on_closing(self) -> None:
+        self._finish_pending_save()  # a scan that is being saved in the background is written before exiting
         try:
             self.stop_scan()
         except Exception as e:
             logger.debug(e)
+        try:
+            self.application_controller.position_controller.close()
+        except Exception as e:
+            logger.debug(e)
         finally:
             self.root_window.quit()
             self.root_window.destroy()
@@ -105,12 +105,16 @@ class ScopeFigure:
         self.ydata.popleft()
         self.ydata.append(y)
 
-        delta = 0.1*np.max(self.ydata)
-        new_min = np.max([0, np.min(self.ydata) - delta])
-        new_max = np.max(self.ydata) + delta
+        # the data are converted to an array once per update, and the limits clamped with builtin max.
+        # The data limit is its first argument, so that a nan propagates as it would with np.max
+        ydata = np.fromiter(self.ydata, dtype=float, count=len(self.ydata))
+        ydata_min, ydata_max = ydata.min(), ydata.max()
+        delta = 0.1*ydata_max
+        new_min = max(ydata_min - delta, 0)
+        new_max = ydata_max + delta
         current_min, current_max = self.ax.get_ylim()
         if (np.abs((new_min - current_min)/(current_min)) > 0.12) or (np.abs((new_max - current_max)/(current_max)) > 0.12):
-            self.ax.set_ylim(np.max([0.01, np.min(self.ydata) - delta]), np.max(self.ydata) + delta)
+            self.ax.set_ylim(max(ydata_min - delta, 0.01), new_max)
         self.line.set_ydata(self.ydata)
         return (self.line,)
 
@@ -1,5 +1,6 @@
 from .daqsamplers import RandomRateCounter
 from .daqsamplers import NiDaqDigitalInputRateCounter
 from .piezoscanner import CounterAndScanner
+from .piezoscanner import CounterAndScanner as BasePiezoScanner
 from .piezoscanner import CounterAndScanner as NiDaqPiezoScanner
 from .piezoscanner import CounterAndScanner as RandomPiezoScanner
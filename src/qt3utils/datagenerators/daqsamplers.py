@@ -1,7 +1,7 @@
-import time
 import logging
 import abc
-from typing import Generator
+import threading
+from typing import Generator, Union
 
 import numpy as np
 import nidaqmx
@@ -10,15 +10,38 @@ import qt3utils.nidaq
 
 logger = logging.getLogger(__name__)
 
+_random_seed_sequence = np.random.SeedSequence()
+""" Spawns an independent random number stream for each RandomRateCounter instance. """
+
+_EMPTY_BATCH = np.zeros(1)
+_EMPTY_BATCH.flags.writeable = False
+""" Returned with samples_read = 0 by _read_samples when no batch was read, instead of allocating a new array. """
+
+
+def _batch_data_array(n_batches: int, out: np.ndarray = None) -> np.ndarray:
+    """
+    Returns out, after checking its shape, or a new array of shape (n_batches, 2) if out is None.
+
+    The new array is stored in column-major (Fortran) order, so that the counts and the clock samples
+    are each contiguous in memory. The per-batch sums are written into, and reduced from, a contiguous column.
+    """
+    if out is None:
+        return np.zeros((n_batches, 2), order='F')
+    if out.shape != (n_batches, 2):
+        raise ValueError(f'out must have shape {(n_batches, 2)}, not {out.shape}')
+    return out
+
 
 class RateCounterBase(abc.ABC):
     """
-    Subclasses must implement a clock_rate attribute or property.
+    Subclasses must implement a clock_rate and a num_data_samples_per_batch attribute or property.
     """
 
     def __init__(self):
         self.running = False
         self.clock_rate = 0
+        self.num_data_samples_per_batch = 0
+        self._raw_counts_buffer = np.empty((0, 0), dtype=np.float32)
 
     def stop(self):
         """
@@ -43,11 +66,12 @@ class RateCounterBase(abc.ABC):
         """
         subclasses must implement this method
 
-        Should return total_counts, num_clock_samples
+        Should return an array of the counts of each clock sample and the number of clock samples read
+        into it, samples_read. Only the first samples_read values of the array are used.
         """
         pass
 
-    def sample_counts(self, n_batches=1, sum_counts=True) -> np.ndarray:
+    def sample_counts(self, n_batches=1, sum_counts=True, out=None) -> np.ndarray:
         """
         Performs n_batches of batch reads from _read_samples method.
 
@@ -97,22 +121,62 @@ class RateCounterBase(abc.ABC):
         If sum_counts is True, data will be summed along axis=0 with keepdim=True,
         resulting in a numpy array of shape (1, 2).
         Following the example, the return value would be [[66, 14]].
+
+        If out is given, it must be a float numpy array of shape (n_batches, 2). The per-batch data
+        are written into it instead of a newly allocated array, so that callers that
+        sample repeatedly may reuse the same array. When the data are not summed, or n_batches is 1,
+        out itself is returned.
         """
 
-        data = np.zeros((n_batches, 2))
+        if self.num_data_samples_per_batch == 1:
+            data = self._sample_scalar_batch_counts(n_batches, out)
+        else:
+            data = self._sample_vector_batch_counts(n_batches, out)
+        if logger.isEnabledFor(logging.INFO):  # avoid formatting the data array when it will not be logged
+            logger.info(f'batch data (sum counts, num clock cycles per batch): {data}')
+
+        if sum_counts and n_batches > 1:
+            return data.sum(axis=0, keepdims=True)
+        else:
+            return data  # a single batch is already its own sum
+
+    def _sample_scalar_batch_counts(self, n_batches: int, out: np.ndarray = None) -> np.ndarray:
+        """
+        Returns the (n_batches, 2) batch data when each batch holds a single clock sample.
+
+        The count of each batch is copied directly, which avoids the reduction buffer
+        and the per-batch array slicing used for larger batches.
+        """
+        data = _batch_data_array(n_batches, out)
         for i in range(n_batches):
             data_sample, samples_read = self._read_samples()
-            if samples_read > 0:
-                data[i][0] = np.sum(data_sample[:samples_read])
-            data[i][1] = samples_read
-            logger.info(f'batch data (sum counts, num clock cycles per batch): {data[i]}')
+            data[i, 0] = data_sample[0] if samples_read > 0 else 0
+            data[i, 1] = samples_read
+        return data
 
-        if sum_counts:
-            return np.sum(data, axis=0, keepdims=True)
-        else:
-            return data
+    def _sample_vector_batch_counts(self, n_batches: int, out: np.ndarray = None) -> np.ndarray:
+        """
+        Returns the (n_batches, 2) batch data for batches of num_data_samples_per_batch clock samples.
+        """
+        data = _batch_data_array(n_batches, out)
+        # counts per clock sample are small integers, so float32 holds them exactly while halving the memory
+        # traffic of the reduction. The sums are accumulated in float64.
+        # The buffer is kept between calls so that repeated calls, as in yield_count_rate, do not reallocate it.
+        if self._raw_counts_buffer.shape != (n_batches, self.num_data_samples_per_batch):
+            self._raw_counts_buffer = np.empty((n_batches, self.num_data_samples_per_batch), dtype=np.float32)
+        raw_counts = self._raw_counts_buffer
+        for i in range(n_batches):
+            data_sample, samples_read = self._read_samples()
+            raw_counts[i, :samples_read] = data_sample[:samples_read]
+            raw_counts[i, samples_read:] = 0  # only the (rare) samples missing from a short batch are zeroed
+            data[i, 1] = samples_read
+
+        # samples that were not returned by the hardware stay at zero, so every batch is summed in a single
+        # reduction, written straight into the counts column rather than through a temporary array
+        np.add.reduce(raw_counts, axis=1, dtype=np.float64, out=data[:, 0])
+        return data
 
-    def sample_count_rate(self, data_counts: np.ndarray) -> np.floating:
+    def sample_count_rate(self, data_counts: np.ndarray) -> Union[np.floating, np.ndarray]:
         """
         Converts the average count rate given the data_counts, using the object's
         clock_rate value. Expects data_counts to be a 2d numpy array
@@ -123,17 +187,72 @@ class RateCounterBase(abc.ABC):
             = self.clock_rate * total counts/ total clock_samples)
 
         If the sum of all clock_samples is 0, will return np.nan.
+
+        data_counts may also have leading dimensions, such as the (N, n_batches, 2) array
+        of sample_counts results along a scan axis. In that case the batches of each row are summed
+        and an array of count rates with the leading shape, (N,), is returned.
         """
-        _data = np.sum(data_counts, axis=0)
-        if _data[1] > 0:
-            return self.clock_rate * _data[0] / _data[1]
+        data_counts = np.asarray(data_counts)
+        if data_counts.shape == (1, 2):
+            # the single row returned by sample_counts(sum_counts=True) needs no reduction
+            counts, clock_samples = data_counts[0].tolist()
+            return self.clock_rate * counts / clock_samples if clock_samples > 0 else np.nan
+
+        if data_counts.shape[-2] == 1:
+            # one batch per row, as in the scan lines of summed sample_counts results, needs no reduction
+            _data = data_counts[..., 0, :]
+        else:
+            _data = data_counts.sum(axis=-2)
+        counts, clock_samples = _data[..., 0], _data[..., 1]
+        count_rate = np.full(clock_samples.shape, np.nan)
+        np.divide(counts, clock_samples, out=count_rate, where=clock_samples > 0)
+        count_rate *= self.clock_rate  # scaled in place rather than scaling the counts into a temporary array
+        return count_rate[()]
+
+    def _sample_single_batch_count_rate(self) -> float:
+        """
+        Reads a single batch from _read_samples and returns its count rate in counts/second,
+        or np.nan if no clock samples were read.
+        """
+        data_sample, samples_read = self._read_samples()
+        if samples_read > 0:
+            return self.clock_rate * float(data_sample[:samples_read].sum()) / samples_read
         else:
             return np.nan
 
-    def yield_count_rate(self) -> Generator[np.floating, None, None]:
+    def yield_count_rate(self, smoothing_factor: float = 1.0) -> Generator[np.floating, None, None]:
+        """
+        Yields the count rate of one batch at a time while running.
+
+        If smoothing_factor (alpha) is less than 1, the exponentially weighted moving average
+            rate = alpha * batch rate + (1 - alpha) * previous rate
+        is yielded instead. The default of 1 yields each batch count rate without smoothing.
+        """
+        count_rate = np.nan
+        while self.running:
+            batch_count_rate = self._sample_single_batch_count_rate()
+            if smoothing_factor < 1 and not np.isnan(count_rate):
+                count_rate = smoothing_factor * batch_count_rate + (1 - smoothing_factor) * count_rate
+            else:
+                count_rate = batch_count_rate
+            yield count_rate
+
+    def iter_count_rates(self, batch_size: int = 16) -> Generator[np.ndarray, None, None]:
+        """
+        Yields arrays of the count rates of batch_size batches at a time while running,
+        for consumers that process the rates in bulk rather than one at a time.
+
+        The yielded array is reused by the next iteration, so callers that keep the rates should copy them.
+        If the counter is stopped part way through, the rates read so far are yielded, unless there are none.
+        """
+        count_rates = np.empty(batch_size)
         while self.running:
-            count_data = self.sample_counts()  # because n_batches=1 (and sum=True) this returns a 2d array of shape (1, 2)
-            yield self.sample_count_rate(count_data)  # because count_data is 2d, sample count rate returns a float c
+            n_rates = 0
+            while n_rates < batch_size and self.running:
+                count_rates[n_rates] = self._sample_single_batch_count_rate()
+                n_rates += 1
+            if n_rates > 0:
+                yield count_rates[:n_rates]
 
 
 class RandomRateCounter(RateCounterBase):
@@ -158,34 +277,133 @@ class RandomRateCounter(RateCounterBase):
         self.simulate_single_light_source = simulate_single_light_source
         self.possible_offset_values = np.arange(5000, 100000, 1000)  # these create the "bright" positions
         self.num_data_samples_per_batch = num_data_samples_per_batch
+        self.rng = np.random.default_rng(_random_seed_sequence.spawn(1)[0])
+        # holds the three random values used to update the offset followed by the random counts
+        self._random_buffer = np.empty(3)
 
     def _read_samples(self):
         """
         Returns a random number of counts
+
+        The returned array is a buffer that is reused by the next call.
         """
+        if self._random_buffer.size != self.num_data_samples_per_batch + 3:
+            self._random_buffer = np.empty(self.num_data_samples_per_batch + 3)
+
+        # all random values of this batch are drawn in one call. The three values used to update
+        # the offset are compared as python floats, which is cheaper than indexing numpy scalars
+        self.rng.random(out=self._random_buffer)
+        r_offset, r_direction, r_choice = self._random_buffer[:3].tolist()
+        # a uniformly chosen entry of possible_offset_values, as a python int so that
+        # current_offset stays a python number rather than a slower numpy scalar
+        offset_choice = self.possible_offset_values.item(int(r_choice * self.possible_offset_values.size))
         if self.simulate_single_light_source:
-            if np.random.random(1)[0] < 0.005:
-                self.current_offset = np.random.choice(self.possible_offset_values)
+            if r_offset < 0.005:
+                self.current_offset = offset_choice
             else:
                 self.current_offset = self.default_offset
 
         else:
-            if np.random.random(1)[0] < 0.05:
-                if np.random.random(1)[0] < 0.1:
+            if r_offset < 0.05:
+                if r_direction < 0.1:
                     self.current_direction = -1 * self.current_direction
-                self.current_offset += self.current_direction * np.random.choice(self.possible_offset_values)
+                self.current_offset += self.current_direction * offset_choice
 
             if self.current_offset < self.default_offset:
                 self.current_offset = self.default_offset
                 self.current_direction = 1
 
-        counts = self.signal_noise_amp * self.current_offset * np.random.random(
-            self.num_data_samples_per_batch) + self.current_offset
+        counts = self._random_buffer[3:]
+        counts *= self.signal_noise_amp * self.current_offset
+        counts += self.current_offset
 
         return counts, self.num_data_samples_per_batch
 
 
+class _SPSCRing:
+    """
+    A single-producer, single-consumer ring buffer of batches, preallocated as a
+    (capacity, batch_size) numpy array.
+
+    No lock is needed: only the producer advances the head, after its batch has been
+    written, and only the consumer advances the tail, after its batch has been copied out.
+    The capacity must be a power of two so that slots are found with a bit mask.
+    """
+
+    def __init__(self, capacity: int, batch_size: int):
+        if capacity < 1 or capacity & (capacity - 1):
+            raise ValueError(f'capacity must be a power of two, not {capacity}')
+        self.capacity = capacity
+        self._mask = capacity - 1
+        self._batches = np.empty((capacity, batch_size))
+        self._sizes = np.zeros(capacity, dtype=int)
+        self._head = 0  # number of batches written by the producer
+        self._tail = 0  # number of batches taken by the consumer
+
+    def __len__(self) -> int:
+        return self._head - self._tail
+
+    def is_full(self) -> bool:
+        return self._head - self._tail >= self.capacity
+
+    def free_slot(self) -> np.ndarray:
+        """
+        Returns the slot the producer writes the next batch into. Only valid when the ring is not full.
+        """
+        return self._batches[self._head & self._mask]
+
+    def publish(self, size: int) -> None:
+        """
+        Makes the batch written into free_slot, of which the first size values are valid, available to the consumer.
+        """
+        self._sizes[self._head & self._mask] = size
+        self._head += 1
+
+    def pop_into(self, out: np.ndarray) -> int:
+        """
+        Copies the oldest batch into out and returns its size. Only valid when the ring is not empty.
+        """
+        slot = self._tail & self._mask
+        size = self._sizes[slot]
+        out[:size] = self._batches[slot, :size]
+        self._tail += 1
+        return size
+
+    def pop_latest_into(self, out: np.ndarray) -> int:
+        """
+        Copies the newest batch into out, discards all older batches and returns its size.
+        Only valid when the ring is not empty.
+
+        The tail is only moved past the older batches once the copy is done, so the producer
+        cannot write into the slot being copied (it only writes while the ring is not full,
+        into the slot after the newest batch).
+        """
+        head = self._head
+        slot = (head - 1) & self._mask
+        size = self._sizes[slot]
+        out[:size] = self._batches[slot, :size]
+        self._tail = head
+        return size
+
+
 class NiDaqDigitalInputRateCounter(RateCounterBase):
+    """
+    Reads the count rate of a digital TTL signal with an NI DAQ edge counter.
+
+    By default, a FINITE counter task is started and stopped for every batch that is read,
+    so each batch contains only samples acquired after the read was requested.
+
+    When 'continuous_acquisition' is True, the counter task runs CONTINUOUSLY between start and stop
+    and the NI DAQ driver calls back every num_data_samples_per_batch samples. Each batch is copied
+    into a preallocated ring buffer and _read_samples takes batches from it, so no task is started or stopped
+    per batch. Each read returns the most recent batch and discards any older ones, so a reader that is
+    slower than the acquisition, such as the qt3scope display, always shows current data rather than falling
+    further and further behind. This makes this mode suited to live monitoring (qt3scope) rather than to
+    scans that must sample after each stage move.
+    """
+
+    MAX_BUFFERED_BATCHES = 16
+    """ The maximum number of batches held in the ring buffer during continuous acquisition. Must be a power of two. """
 
     def __init__(self, daq_name='Dev1',
                  signal_terminal='PFI0',
@@ -195,6 +413,7 @@ class NiDaqDigitalInputRateCounter(RateCounterBase):
                  read_write_timeout=10,
                  signal_counter='ctr2',
                  trigger_terminal=None,
+                 continuous_acquisition=False,
                  ):
         super().__init__()
         self.daq_name = daq_name
@@ -205,8 +424,11 @@ class NiDaqDigitalInputRateCounter(RateCounterBase):
         self.read_write_timeout = read_write_timeout
         self.num_data_samples_per_batch = num_data_samples_per_batch
         self.trigger_terminal = trigger_terminal
+        self.continuous_acquisition = continuous_acquisition
 
-        self.read_lock = False
+        self._read_done = threading.Event()  # cleared while a finite batch read is in progress
+        self._read_done.set()
+        self._sample_data_ready = threading.Event()
 
     def _configure_daq(self):
         self.nidaq_config = qt3utils.nidaq.EdgeCounter(self.daq_name)
@@ -223,37 +445,106 @@ class NiDaqDigitalInputRateCounter(RateCounterBase):
             N_samples_to_acquire_or_buffer_size=self.num_data_samples_per_batch,
             clock_terminal=clock_terminal,
             trigger_terminal=self.trigger_terminal,
-            sampling_mode=nidaqmx.constants.AcquisitionType.FINITE)
+            sampling_mode=nidaqmx.constants.AcquisitionType.CONTINUOUS if self.continuous_acquisition
+            else nidaqmx.constants.AcquisitionType.FINITE)
 
         self.nidaq_config.create_counter_reader()
+        # bound once here to avoid resolving the attribute chain on every batch
+        self._read_many_sample_double = self.nidaq_config.counter_reader.read_many_sample_double
+        self._counter_task = self.nidaq_config.counter_task
+        # the batch size and timeout are fixed for this configuration, so the read arguments are built once.
+        # the batch size also must stay equal to the size of the data buffer allocated below.
+        self._read_kwargs = dict(number_of_samples_per_channel=self.num_data_samples_per_batch,
+                                 timeout=self.read_write_timeout)
+
+        # the read buffer is allocated once per configuration and reused by every call to _read_samples
+        self._data_buffer = np.empty(self.num_data_samples_per_batch)
+
+        if self.continuous_acquisition:
+            self._ring = _SPSCRing(self.MAX_BUFFERED_BATCHES, self.num_data_samples_per_batch)
+            self._scratch_buffer = np.empty(self.num_data_samples_per_batch)
+            self._sample_data_ready.clear()
+            # the on-board buffer holds as many batches as the ring so that a slow callback does not overflow it
+            self.nidaq_config.counter_task.in_stream.input_buf_size = \
+                self.MAX_BUFFERED_BATCHES * self.num_data_samples_per_batch
+            self.nidaq_config.counter_task.register_every_n_samples_acquired_into_buffer_event(
+                self.num_data_samples_per_batch, self._continuous_sampling_callback)
+
+    def _continuous_sampling_callback(self, task_handle, every_n_samples_event_type, number_of_samples,
+                                      callback_data):
+        """
+        Called by the NI DAQ driver each time number_of_samples have been acquired into the buffer
+        during continuous acquisition. Reads the batch directly into the ring buffer.
+
+        If the ring buffer is full, which only happens if the reader has stalled, the batch is still read,
+        to keep the driver buffer from overflowing, but into a scratch buffer and then dropped. The reader
+        skips to the newest batch on its next read.
+        """
+        try:
+            ring_is_full = self._ring.is_full()
+            samples_read = self._read_many_sample_double(
+                self._scratch_buffer if ring_is_full else self._ring.free_slot(),
+                number_of_samples_per_channel=number_of_samples,
+                timeout=self.read_write_timeout)
+            if ring_is_full:
+                logger.debug('ring buffer is full, dropping batch')
+            else:
+                self._ring.publish(samples_read)
+            self._sample_data_ready.set()
+        except Exception as e:
+            logger.error(f'in continuous sampling callback. {type(e)}: {e}')
+        return 0
+
+    def _read_buffered_samples(self):
+        """
+        Returns the newest batch acquired during continuous acquisition, waiting up to
+        read_write_timeout seconds for one to arrive. Older batches that have not been read are discarded.
+
+        The batch is copied out of the ring buffer into the data buffer that is reused by the next call.
+        """
+        while len(self._ring) == 0:
+            if self.running is False:
+                return _EMPTY_BATCH, 0
+            if not self._sample_data_ready.wait(self.read_write_timeout):
+                logger.error(f'no data acquired within {self.read_write_timeout} seconds')
+                return _EMPTY_BATCH, 0
+            self._sample_data_ready.clear()
+
+        n_skipped = len(self._ring) - 1
+        if n_skipped > 0:
+            logger.debug('skipping %d older batches', n_skipped)
+        samples_read = self._ring.pop_latest_into(self._data_buffer)
+        return self._data_buffer, samples_read
 
     def _read_samples(self):
+        """
+        Returns the data buffer and the number of samples read into it.
+
+        The buffer is reused by the next call, and only the first samples_read values are valid.
+        """
 
         if self.running is False:  # external thread could have stopped
-            return np.zeros(1), 0
+            return _EMPTY_BATCH, 0
+
+        if self.continuous_acquisition:
+            return self._read_buffered_samples()
 
-        data_buffer = np.zeros(self.num_data_samples_per_batch)
+        data_buffer = self._data_buffer
+        counter_task = self._counter_task
         samples_read = 0
 
         try:
-            self.read_lock = True
+            self._read_done.clear()
             logger.info('starting counter task')
-            self.nidaq_config.counter_task.wait_until_done()
-            self.nidaq_config.counter_task.start()
-            # DO WE NEED TO PAUSE HERE FOR DATA ACQUISITION?
-            # another method will probably be to configure the task to continuously fill a buffer and read it
-            # out... then we don't need to start and stop, right? TODO
-            # and, with continuous acquisition, there might not need to be any time.sleep
-            logger.info(
-                f'waiting for {1.1 * self.num_data_samples_per_batch / self.clock_rate:.6f}'
-                f' seconds for data acquisition.')
-            time.sleep(1.1 * self.num_data_samples_per_batch / self.clock_rate)
+            counter_task.wait_until_done()
+            counter_task.start()
+            # the FINITE task signals completion as soon as all samples have been acquired,
+            # so we wait for that rather than sleeping for a fixed, padded acquisition time.
+            logger.info('waiting for data acquisition')
+            counter_task.wait_until_done(timeout=self.read_write_timeout)
             logger.info('reading data')
-            samples_read = self.nidaq_config.counter_reader.read_many_sample_double(
-                data_buffer,
-                number_of_samples_per_channel=self.num_data_samples_per_batch,
-                timeout=self.read_write_timeout)
-            logger.info(f'returned {samples_read} samples')
+            samples_read = self._read_many_sample_double(data_buffer, **self._read_kwargs)
+            logger.info('returned %d samples', samples_read)
 
         except Exception as e:
             logger.error(f'{type(e)}: {e}')
@@ -261,11 +552,11 @@ class NiDaqDigitalInputRateCounter(RateCounterBase):
 
         finally:
             try:
-                self.nidaq_config.counter_task.stop()
+                counter_task.stop()
             except Exception as e:
                 logger.error(f'in finally.stop. {type(e)}: {e}')
 
-            self.read_lock = False
+            self._read_done.set()
             return data_buffer, samples_read
 
     def start(self):
@@ -275,27 +566,34 @@ class NiDaqDigitalInputRateCounter(RateCounterBase):
         self._configure_daq()
         if self.nidaq_config.clock_task:
             self.nidaq_config.clock_task.start()
+        if self.continuous_acquisition:
+            self.nidaq_config.counter_task.start()
         self.running = True
 
-    def _burn_and_log_exception(self, f):
-        try:
-            f()
-        except Exception as e:
-            logger.debug(e)
-            pass
-
     def stop(self):
         if self.running:
-            while self.read_lock:
-                time.sleep(0.1)  # wait for current read to complete
-
+            self.running = False
+            self._sample_data_ready.set()  # wake up a reader waiting for continuously acquired data
+            # wait for the current read to complete, but not forever if the driver hangs
+            if not self._read_done.wait(timeout=self.read_write_timeout + 1):
+                logger.warning(f'read did not complete within {self.read_write_timeout + 1} seconds, '
+                               'closing the tasks anyway')
+
+            cleanup_steps = []
             if self.nidaq_config.clock_task:
-                self._burn_and_log_exception(self.nidaq_config.clock_task.stop)
-                self._burn_and_log_exception(
-                    self.nidaq_config.clock_task.close)  # close the task to free resource on NIDAQ
-            # self._burn_and_log_exception(self.nidaq_config.counter_task.stop) # will need to stop task if we move
-            # to continuous buffered acquisition
-            self._burn_and_log_exception(self.nidaq_config.counter_task.close)
+                # close the task to free resource on NIDAQ
+                cleanup_steps += [('clock_task.stop', self.nidaq_config.clock_task.stop),
+                                  ('clock_task.close', self.nidaq_config.clock_task.close)]
+            if self.continuous_acquisition:
+                cleanup_steps.append(('counter_task.stop', self.nidaq_config.counter_task.stop))
+            cleanup_steps.append(('counter_task.close', self.nidaq_config.counter_task.close))
+
+            # every step is attempted, even if a previous one fails
+            for step_name, step in cleanup_steps:
+                try:
+                    step()
+                except Exception as e:
+                    logger.debug(f'{step_name}: {type(e)}: {e}')
 
         self.running = False
 
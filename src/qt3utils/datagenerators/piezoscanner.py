@@ -1,3 +1,5 @@
+import functools
+
 import numpy as np
 import scipy.optimize
 import time
@@ -6,16 +8,84 @@ import logging
 logger = logging.getLogger(__name__)
 
 
-def gauss(x, *p):
+def gauss(x, *p, out=None):
+    """
+    Gaussian with an offset, C * exp(-(x - mu)**2 / (2 * sigma**2)) + offset, where p = (C, mu, sigma, offset).
+
+    The result is written into out when it is given, rather than into a new array.
+    """
     C, mu, sigma, offset = p
-    return C * np.exp(-(x - mu) ** 2 / (2. * sigma ** 2)) + offset
+    # evaluated in place in a single working array; curve_fit calls this many times per fit
+    if out is None:
+        y = np.array(x, dtype=np.float64)
+        y -= mu
+    else:
+        y = np.subtract(x, mu, out=out)
+    np.square(y, out=y)
+    y *= -0.5 / np.float64(sigma) ** 2
+    np.exp(y, out=y)
+    y *= C
+    y += offset
+    return y
+
+
+def gauss_jac(x, *p):
+    """
+    Analytic Jacobian of gauss with respect to (C, mu, sigma, offset), in the shape (len(x), 4).
+    Passed to curve_fit so it does not estimate the Jacobian with extra calls to gauss.
+    """
+    C, mu, sigma, offset = p
+    d = np.subtract(x, mu, dtype=np.float64)
+    inv_s2 = 1. / np.float64(sigma) ** 2
+    jac = np.empty((d.size, 4))
+    e = jac[:, 0]
+    np.multiply(d, d, out=e)
+    e *= -0.5 * inv_s2
+    np.exp(e, out=e)
+    np.multiply(e, d, out=jac[:, 1])
+    jac[:, 1] *= C * inv_s2
+    np.multiply(jac[:, 1], d, out=jac[:, 2])
+    jac[:, 2] /= sigma
+    jac[:, 3] = 1.
+    return jac
+
+
+@functools.lru_cache(maxsize=32)
+def scan_positions(min_val, max_val, step_size):
+    """
+    Returns the positions from min_val to max_val, inclusive, in steps of step_size.
+
+    The number of positions is computed once from the range and each position is generated
+    from an integer index, so the result does not depend on how np.arange accumulates
+    rounding errors. np.arange(min_val, max_val + step_size, step_size) may return one
+    position more or less than expected, or a last position beyond max_val.
+
+    The same scan ranges are used repeatedly (every row of a scan, every optimization along an
+    axis), so the results are cached. The returned array is shared and read-only.
+    """
+    n = int(np.floor((max_val - min_val) / step_size + 1e-9)) + 1
+    positions = min_val + step_size * np.arange(n)
+    # rounding must not take the last position past max_val, which may be the stage limit
+    np.minimum(positions, max_val, out=positions)
+    positions.flags.writeable = False
+    return positions
 
 
 class CounterAndScanner:
+    # the attributes are stored in slots rather than an instance __dict__, which makes the attribute
+    # accesses in the scan loops (still_scanning, move_y, scan_x) direct
+    __slots__ = (
+        'running', 'current_y', '_row',
+        'xmin', 'xmax', 'ymin', 'ymax', 'step_size', 'raster_line_pause',
+        'scanned_raw_counts', 'scanned_count_rate', '_raw_counts_buffer', '_count_rate_buffer',
+        'stage_controller', 'rate_counter', 'num_daq_batches',
+    )
+
     def __init__(self, rate_counter, stage_controller):
 
         self.running = False
         self.current_y = 0
+        self._row = 0  # index of the row at current_y
         self.ymin = stage_controller.minimum_allowed_position
         self.ymax = stage_controller.maximum_allowed_position
         self.xmin = stage_controller.minimum_allowed_position
@@ -25,11 +95,22 @@ class CounterAndScanner:
 
         self.scanned_raw_counts = []
         self.scanned_count_rate = []
+        # arrays allocated for all rows of the scan, of which scanned_raw_counts and
+        # scanned_count_rate are views of the rows scanned so far
+        self._raw_counts_buffer = None
+        self._count_rate_buffer = None
 
         self.stage_controller = stage_controller
         self.rate_counter = rate_counter
         self.num_daq_batches = 1  # could change to 10 if want 10x more samples for each position
 
+    @property
+    def controller(self):
+        """
+        The stage controller, under the name used by the former BasePiezoScanner classes.
+        """
+        return self.stage_controller
+
     def stop(self):
         self.running = False
 
@@ -41,6 +122,7 @@ class CounterAndScanner:
         self.rate_counter.start()
 
     def set_to_starting_position(self):
+        self._row = 0
         self.current_y = self.ymin
         if self.stage_controller:
             self.stage_controller.go_to_position(x=self.xmin, y=self.ymin)
@@ -52,6 +134,11 @@ class CounterAndScanner:
         return self.rate_counter.sample_counts(self.num_daq_batches)
 
     def sample_count_rate(self, data_counts=None):
+        """
+        Returns the count rate of data_counts, or of a new sample if data_counts is None.
+        If data_counts is a scan line of sample_counts results, of shape (N, 1, 2),
+        an array of N count rates is returned.
+        """
         if data_counts is None:
             data_counts = self.sample_counts()
         return self.rate_counter.sample_count_rate(data_counts)
@@ -84,55 +171,129 @@ class CounterAndScanner:
         if self.running == False:  # this allows external process to stop scan
             return False
 
-        if self.current_y <= self.ymax:  # stops scan when reaches final position
+        if self._row < self._num_rows():  # stops scan when reaches final position
             return True
         else:
             self.running = False
             return False
 
+    def _num_rows(self):
+        return len(scan_positions(self.ymin, self.ymax, self.step_size))
+
     def move_y(self):
-        if self.stage_controller and self.current_y <= self.ymax:
-            self.current_y += self.step_size
-            try:
-                self.stage_controller.go_to_position(y=self.current_y)
-            except ValueError as e:
-                logger.info(f'out of range\n\n{e}')
+        # the rows are counted, and current_y computed from the row index, so that the number of rows does not
+        # depend on the rounding errors accumulated by adding step_size to current_y
+        num_rows = self._num_rows()
+        if self.stage_controller and self._row < num_rows:
+            self._row += 1
+            self.current_y = self.ymin + self._row * self.step_size
+            if self._row < num_rows:
+                try:
+                    self.stage_controller.go_to_position(y=min(self.current_y, self.ymax))
+                except ValueError as e:
+                    logger.info(f'out of range\n\n{e}')
 
     def scan_x(self):
         """
         Scans the x axis from xmin to xmax in steps of step_size.
 
-        Stores results in self.scanned_raw_counts and self.scanned_count_rate.
+        Every other row is scanned in the reverse direction, from xmax to xmin (a serpentine raster),
+        so that the stage does not travel back to xmin between rows. The data are always stored
+        in order of increasing x.
+
+        Stores results in self.scanned_raw_counts and self.scanned_count_rate, which are
+        arrays of the rows scanned so far.
+        """
+        positions = scan_positions(self.xmin, self.xmax, self.step_size)
+        n_rows = len(self.scanned_raw_counts)
+        reverse = n_rows % 2 == 1
+
+        # the raw counts are acquired directly into the next row of the scan's array
+        self._raw_counts_buffer = self._buffer_for_row(self.scanned_raw_counts, self._raw_counts_buffer,
+                                                       (len(positions), 1, 2))
+        raw_counts_for_axis = self.scan_axis('x', self.xmin, self.xmax, self.step_size,
+                                             positions=positions, out=self._raw_counts_buffer[n_rows],
+                                             reverse=reverse)
+        self.scanned_raw_counts = self._raw_counts_buffer[:n_rows + 1]
+
+        # the count rates of the whole line are computed in a single call
+        count_rate_for_axis = self.rate_counter.sample_count_rate(raw_counts_for_axis)
+        self._count_rate_buffer = self._buffer_for_row(self.scanned_count_rate, self._count_rate_buffer,
+                                                       np.shape(count_rate_for_axis))
+        self._count_rate_buffer[n_rows] = count_rate_for_axis
+        self.scanned_count_rate = self._count_rate_buffer[:n_rows + 1]
+
+    def _buffer_for_row(self, scanned_rows, buffer, row_shape):
         """
-        raw_counts_for_axis = self.scan_axis('x', self.xmin, self.xmax, self.step_size)
-        self.scanned_raw_counts.append(raw_counts_for_axis)
-        self.scanned_count_rate.append([self.sample_count_rate(raw_counts) for raw_counts in raw_counts_for_axis])
+        Returns buffer if it can hold a row of row_shape after the rows in scanned_rows.
 
-    def scan_axis(self, axis, min, max, step_size):
+        Otherwise a new buffer, sized for all the rows of the scan, is allocated, the scanned rows are
+        copied into it and it is returned. That is the case when buffer is not the array that scanned_rows
+        is a view of (at the start of a scan, or after the scanned rows were replaced), when it is full,
+        or when the row shape has changed.
+        """
+        n_rows = len(scanned_rows)
+        if (buffer is None or len(buffer) <= n_rows or buffer.shape[1:] != row_shape
+                or (n_rows > 0 and getattr(scanned_rows, 'base', None) is not buffer)):
+            expected_rows = len(scan_positions(self.ymin, self.ymax, self.step_size))
+            new_buffer = np.empty((max(expected_rows, 2 * n_rows, 1),) + row_shape)
+            if n_rows > 0:
+                new_buffer[:n_rows] = scanned_rows
+            buffer = new_buffer
+        return buffer
+
+    def scan_axis(self, axis, min, max, step_size, positions=None, out=None, reverse=False):
         """
         Moves the stage along the specified axis from min to max in steps of step_size.
-        Returns a list of raw counts from the scan in the shape
+        The positions may be given directly, in which case min, max and step_size are not used
+        to compute them.
+        If reverse is True, the positions are visited from max to min, but the returned
+        counts are still ordered from min to max.
+        Returns a numpy array of raw counts from the scan in the shape (N, 1, 2),
         [[[counts, clock_samples]], [[counts, clock_samples]], ...] where each [[counts, clock_samples]] is the
         result of a single call to sample_counts at each scan position along the axis.
+
+        The array is stored in column-major order, so the counts and the clock samples
+        of the whole line are each contiguous in memory. If out, an array of shape (N, 1, 2), is given,
+        the raw counts are written into it and it is returned instead.
         """
-        raw_counts = []
-        self.stage_controller.go_to_position(**{axis: min})
+        if positions is None:
+            positions = scan_positions(min, max, step_size)
+        if out is None:
+            raw_counts = np.empty((len(positions), 1, 2), order='F')
+        elif out.shape != (len(positions), 1, 2):
+            raise ValueError(f'out must have the shape {(len(positions), 1, 2)}. got {out.shape}')
+        else:
+            raw_counts = out
+        go_to_position = self.stage_controller.go_to_position if self.stage_controller else None
+        # the log messages are formatted lazily, only when they are logged. Reading back the stage position
+        # is a hardware query at every point, so it is only done when debug messages are logged.
+        query_position = go_to_position is not None and logger.isEnabledFor(logging.DEBUG)
+
+        indices = range(len(positions) - 1, -1, -1) if reverse else range(len(positions))
+        if go_to_position:
+            go_to_position(**{axis: positions[indices[0]] if len(positions) else min})
         time.sleep(self.raster_line_pause)
-        for val in np.arange(min, max + step_size, step_size):
-            if self.stage_controller:
-                logger.info(f'go to position {axis}: {val:.2f}')
-                self.stage_controller.go_to_position(**{axis: val})
-            _raw_counts = self.sample_counts()
-            raw_counts.append(_raw_counts)
-            logger.info(f'raw counts, total clock samples: {_raw_counts}')
-            if self.stage_controller:
-                logger.info(f'current position: {self.stage_controller.get_current_position()}')
 
+        # the first position was moved to before the pause. The stage must not move while the counts
+        # at a position are acquired, so each move is completed before sample_counts is called.
+        for k, i in enumerate(indices):
+            if go_to_position and k > 0:
+                logger.info('go to position %s: %.2f', axis, positions[i])
+                go_to_position(**{axis: positions[i]})
+            raw_counts[i] = self.sample_counts()
+            if query_position:
+                logger.debug('current position: %s', self.stage_controller.get_current_position())
+
+        # the raw counts of the line are logged once it is complete rather than at every position
+        logger.info('raw counts, total clock samples: %s', raw_counts[:, 0, :])
         return raw_counts
 
     def reset(self):
         self.scanned_raw_counts = []
         self.scanned_count_rate = []
+        self._raw_counts_buffer = None
+        self._count_rate_buffer = None
 
     def optimize_position(self, axis, center_position, width=2, step_size=0.25):
         """
@@ -162,26 +323,33 @@ class CounterAndScanner:
         min_val = center_position - width
         max_val = center_position + width
         if self.stage_controller:
-            min_val = np.max([min_val, self.stage_controller.minimum_allowed_position])
-            max_val = np.min([max_val, self.stage_controller.maximum_allowed_position])
+            min_val = max(min_val, self.stage_controller.minimum_allowed_position)
+            max_val = min(max_val, self.stage_controller.maximum_allowed_position)
+
+        # the same positions are scanned and fit, so their lengths always match
+        axis_vals = scan_positions(min_val, max_val, step_size)
 
         self.start()
-        raw_counts = self.scan_axis(axis, min_val, max_val, step_size)
+        raw_counts = self.scan_axis(axis, min_val, max_val, step_size, positions=axis_vals)
         self.stop()
         self.post_stop()
-        axis_vals = np.arange(min_val, max_val + step_size, step_size)
-        count_rates = [self.sample_count_rate(count) for count in raw_counts]
+        count_rates = self.rate_counter.sample_count_rate(raw_counts)
 
-        optimal_position = axis_vals[np.argmax(count_rates)]
+        # the brightest position is both the fallback result and the initial guess of mu, and its
+        # count rate is the initial guess of C, so the data are searched for the maximum only once
+        i_max = np.argmax(count_rates)
+        optimal_position = axis_vals[i_max]
         coeff = None
-        params = [np.max(count_rates), optimal_position, 1.0, np.min(count_rates)]
+        params = [count_rates[i_max], optimal_position, 1.0, np.min(count_rates)]
         bounds = ((0, -np.inf, 0, 0), (np.inf, np.inf, np.inf, np.inf))
         try:
-            coeff, var_matrix = scipy.optimize.curve_fit(gauss, axis_vals, count_rates, p0=params, bounds=bounds)
-            optimal_position = coeff[1]
+            # curve_fit subtracts the data from each evaluation of the model right away,
+            # so the model can reuse one output array for all of its evaluations
+            model = functools.partial(gauss, out=np.empty(len(axis_vals)))
+            coeff, var_matrix = scipy.optimize.curve_fit(model, axis_vals, count_rates, p0=params, bounds=bounds,
+                                                         jac=gauss_jac)
             # ensure that the optimal position is within the scan range
-            optimal_position = np.max([min_val, optimal_position])
-            optimal_position = np.min([max_val, optimal_position])
+            optimal_position = min(max_val, max(min_val, coeff[1]))
         except RuntimeError as e:
             logger.warning(e)
 
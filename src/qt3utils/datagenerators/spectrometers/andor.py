@@ -187,7 +187,8 @@ class AndorAPI(object):
             logger = self.logger
 
         if error_code == self.ccd_error_codes.DRV_SUCCESS:
-            logger.debug(f"{task} was successful")
+            # lazily formatted, as this is called after every CCD call and is rarely logged
+            logger.debug("%s was successful", task)
         else:
             logger.warning(f"{task} failed with return code '{repr(self.ccd_error_codes(error_code))[1:-1]}'")
 
@@ -196,7 +197,7 @@ class AndorAPI(object):
             logger = self.logger
 
         if error_code == self.spg.ATSPECTROGRAPH_SUCCESS:
-            logger.debug(f"{task} was successful")
+            logger.debug("%s was successful", task)
         else:
             code_description = self.spg.GetFunctionReturnDescription(error_code, 200)
             logger.warning(f"{task} failed with return code {code_description}")
@@ -1,7 +1,10 @@
+import ctypes
+import functools
 import logging
 import os
-import time
+import threading
 import uuid
+import weakref
 from pathlib import Path
 from typing import Any, List, Literal, Tuple, Union
 
@@ -13,36 +16,152 @@ from qt3utils.datagenerators.spectrometers.spectrometer import SpectrometerConfi
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-try:
-    import clr
+@functools.lru_cache(maxsize=1)
+def _load_lightfield_assemblies() -> bool:
+    """
+    Loads the Lightfield .NET assemblies and the names used from them (lf, String, Double, ...).
 
-    lf_root = Path(os.environ['LIGHTFIELD_ROOT'])
-    automation_path = lf_root / 'PrincetonInstruments.LightField.AutomationV4.dll'
-    addin_path = lf_root / 'AddInViews' / 'PrincetonInstruments.LightFieldViewV4.dll'
-    support_path = lf_root / 'PrincetonInstruments.LightFieldAddInSupportServices.dll'
+    This is called when a Princeton spectrometer is first created or the Lightfield application
+    is first initialized, rather than when this module is imported, so that importing the module
+    does not load the .NET runtime or require a Lightfield installation. The assemblies are only loaded once.
+    Returns True if they were loaded successfully.
+    """
+    global clr, lf, List, String, Int32, Int64, Double, FileAccess, GCHandle, GCHandleType
+    try:
+        import clr
+
+        lf_root = Path(os.environ['LIGHTFIELD_ROOT'])
+        automation_path = lf_root / 'PrincetonInstruments.LightField.AutomationV4.dll'
+        addin_path = lf_root / 'AddInViews' / 'PrincetonInstruments.LightFieldViewV4.dll'
+        support_path = lf_root / 'PrincetonInstruments.LightFieldAddInSupportServices.dll'
+
+        addin_class = clr.AddReference(str(addin_path))
+        automation_class = clr.AddReference(str(automation_path))
+        support_class = clr.AddReference(str(support_path))
+
+        import PrincetonInstruments.LightField as lf
+
+        clr.AddReference("System.Collections")
+        clr.AddReference("System.IO")
+        from System.Collections.Generic import List
+        from System import String, Int32, Int64, Double
+        from System.IO import FileAccess
+        from System.Runtime.InteropServices import GCHandle, GCHandleType
+    except KeyError as e:
+        logger.error(f"KeyError {e} during import")
+        return False
+    except ImportError as e:
+        logger.error(f"Unable to import packages: {e}")
+        return False
+    return True
+
+
+def _require_lightfield_assemblies() -> None:
+    """
+    Loads the Lightfield .NET assemblies, raising a QT3Error if they cannot be loaded.
+    """
+    if not _load_lightfield_assemblies():
+        raise QT3Error("Unable to load the Lightfield .NET assemblies. Check that pythonnet is installed "
+                       "and that LIGHTFIELD_ROOT is set to the Lightfield installation directory.")
 
-    addin_class = clr.AddReference(str(addin_path))
-    automation_class = clr.AddReference(str(automation_path))
-    support_class = clr.AddReference(str(support_path))
 
-    import PrincetonInstruments.LightField as lf
+_NET_ELEMENT_TYPES = {
+    np.dtype(np.uint16): 'System.UInt16',
+    np.dtype(np.int16): 'System.Int16',
+    np.dtype(np.uint32): 'System.UInt32',
+    np.dtype(np.int32): 'System.Int32',
+    np.dtype(np.float32): 'System.Single',
+    np.dtype(np.float64): 'System.Double',
+}
+""" The .NET element type of an array that can be copied byte for byte into each numpy dtype. """
 
-    clr.AddReference("System.Collections")
-    clr.AddReference("System.IO")
-    from System.Collections.Generic import List
-    from System import String, Int32, Int64, Double
-    from System.IO import FileAccess
-except KeyError as e:
-    logger.error(f"KeyError {e} during import")
-except ImportError as e:
-    logger.error(f"Unable to import packages: {e}")
+
+def _can_copy_net_array(net_array: Any, dtype: Any, count: int) -> bool:
+    """
+    Returns True if net_array is a .NET array of count elements whose element type
+    has the same memory layout as dtype, so that it can be copied byte for byte.
+    """
+    try:
+        element_type = net_array.GetType().GetElementType().FullName
+        length = net_array.Length
+    except Exception:
+        return False
+    return length == count and element_type == _NET_ELEMENT_TYPES.get(np.dtype(dtype))
+
+
+def _net_array_to_numpy(net_array: Any, dtype: Any, count: int, out: np.ndarray = None) -> np.ndarray:
+    """
+    Copies a one dimensional .NET array of a primitive type into a numpy array of the given dtype.
+
+    The .NET array is pinned and copied with a single memmove, instead of iterating
+    over it element by element across the Python/.NET boundary. The memmove is only used
+    when the array has count elements of the .NET type matching dtype. Otherwise, or if the
+    array cannot be pinned, it falls back to np.fromiter, which converts each element to dtype
+    and raises a ValueError if the number of elements is not count.
+    If out is given, it must be a contiguous array of count elements of dtype, and is filled and returned.
+    """
+    if out is None:
+        out = np.empty(count, dtype=dtype)
+    handle = None
+    if _can_copy_net_array(net_array, dtype, count):
+        try:
+            handle = GCHandle.Alloc(net_array, GCHandleType.Pinned)
+        except Exception as e:
+            logger.debug(f"Unable to pin the .NET array, copying it element by element: {e}")
+    else:
+        logger.debug(f"The .NET array does not hold {count} values of type {np.dtype(dtype)}, "
+                     f"copying it element by element")
+    if handle is None:
+        out[:] = np.fromiter(net_array, dtype=dtype)
+        return out
+    try:
+        ctypes.memmove(out.ctypes.data, handle.AddrOfPinnedObject().ToInt64(), out.nbytes)
+    finally:
+        handle.Free()
+    return out
+
+
+def _dispose_automation(automation: Any) -> None:
+    """
+    Disposes of a Lightfield automation object, closing its AddInProcess.exe.
+    """
+    try:
+        automation.Dispose()
+        logger.info('Closed AddInProcess.exe')
+    except Exception as e:
+        logger.error(f"Error disposing Lightfield automation: {e}")
 
 
 class LightfieldApplicationManager:
+    """
+    Manages the Lightfield automation, application and experiment.
+
+    The automation is disposed of by close(), or when leaving a `with` block that uses the manager.
+    If neither is done, it is disposed of by a weakref.finalize callback when the manager is garbage
+    collected or, at the latest, when the interpreter exits, while the .NET runtime is still loaded.
+    """
+    def __init__(self):
+        self._automation = None
+        self._application = None
+        self._experiment = None
+        self._finalizer = None
+        self._acquisition_completed = threading.Event()
+        self._pixel_buffer = np.empty(0, dtype=np.uint16)
+        self.stop_flag = False
+
+    def __enter__(self) -> 'LightfieldApplicationManager':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
     def initialize(self, visible: bool) -> None:
+        _require_lightfield_assemblies()
         self._automation = lf.Automation.Automation(visible, List[String]())
+        self._finalizer = weakref.finalize(self, _dispose_automation, self._automation)
         self._application = self._automation.LightFieldApplication
         self._experiment = self._application.Experiment
+        self._experiment.ExperimentCompleted += self._on_experiment_completed
         self.set(lf.AddIns.ExperimentSettings.FileNameGenerationAttachDate, False)
         self.set(lf.AddIns.ExperimentSettings.FileNameGenerationAttachTime, False)
         self.set(lf.AddIns.ExperimentSettings.FileNameGenerationAttachIncrement, True)
@@ -51,7 +170,17 @@ class LightfieldApplicationManager:
 
     @property
     def experiment(self) -> Any:
+        """
+        The Lightfield experiment. The (visible) Lightfield application is started on first access,
+        if initialize has not been called yet, so that creating a spectrometer does not start it.
+        """
+        if self._experiment is None:
+            self.initialize(True)
         return self._experiment
+
+    @property
+    def is_initialized(self) -> bool:
+        return self._experiment is not None
     
     @property
     def automation(self) -> Any:
@@ -91,14 +220,25 @@ class LightfieldApplicationManager:
     def _file_setup(self) -> None:
         self.set(lf.AddIns.ExperimentSettings.FileNameGenerationBaseFileName, str(uuid.uuid4()))
 
+    def _on_experiment_completed(self, sender: Any, event_args: Any) -> None:
+        """
+        Handler of the experiment's ExperimentCompleted event.
+        """
+        self._acquisition_completed.set()
+
     def _start_acquisition_and_wait(self) -> None:
         """
         Starts the acquisition process and waits until it is completed before carrying on.
+
+        The wait ends as soon as Lightfield raises its ExperimentCompleted event, rather
+        than at the next poll of IsRunning. IsRunning is still checked every 100 ms,
+        as before, in case the event is not raised.
         """
         if self.stop_flag == False:
+            self._acquisition_completed.clear()
             self.experiment.Acquire()
-            while self.experiment.IsRunning:
-                time.sleep(0.1)
+            while not self._acquisition_completed.wait(timeout=0.1) and self.experiment.IsRunning:
+                pass
 
     def _process_acquired_data(self) -> np.ndarray:
         """
@@ -123,7 +263,8 @@ class LightfieldApplicationManager:
             - A vertical section (spanning 400 pixels) represents a range for wavelength averaging.
         """
         frame = image_dataset.GetFrame(0, 0)
-        return np.reshape(np.fromiter(frame.GetData(), dtype='uint16'), [frame.Width, frame.Height], order='F')
+        pixels = _net_array_to_numpy(frame.GetData(), np.uint16, frame.Width*frame.Height)
+        return np.reshape(pixels, [frame.Width, frame.Height], order='F')
 
     def _process_multiple_frames(self, image_dataset: Any) -> np.ndarray:
         """
@@ -131,11 +272,23 @@ class LightfieldApplicationManager:
             - Data from successive exposures is added as a new dimension, then returns a 3D array.
             - Averaging across frames can be done by summing over this additional dimension.
         """
-        data = np.array([])
-        for i in range(image_dataset.Frames):
-            frame = image_dataset.GetFrame(0, i)
-            new_frame = np.reshape(np.fromiter(frame.GetData(), dtype='uint16'), [frame.Width, frame.Height], order='F')
-            data = np.dstack((data, new_frame)) if data.size else new_frame
+        num_frames = image_dataset.Frames
+        first_frame = image_dataset.GetFrame(0, 0)
+        width, height = first_frame.Width, first_frame.Height
+
+        # the cube is allocated once and filled frame by frame, rather than
+        # stacked with np.dstack, which copies the accumulated data for every new frame.
+        data = np.empty((width, height, num_frames), dtype=np.uint16)
+        # the frames are copied from Lightfield through a scratch buffer, which is kept between
+        # acquisitions as it is never returned. The data cube itself is returned to the caller,
+        # so it is not recycled.
+        if self._pixel_buffer.size != width*height:
+            self._pixel_buffer = np.empty(width*height, dtype=np.uint16)
+        pixels = self._pixel_buffer
+        for i in range(num_frames):
+            frame = first_frame if i == 0 else image_dataset.GetFrame(0, i)
+            _net_array_to_numpy(frame.GetData(), np.uint16, width*height, out=pixels)
+            data[:, :, i] = np.reshape(pixels, [width, height], order='F')
         return data
 
     # NOTE: May not need to call the 'start_acquisition_and_wait' method if you fix the 'FileNameGeneration' issue.
@@ -151,9 +304,19 @@ class LightfieldApplicationManager:
     def close(self) -> None:
         """
         Closes the Lightfield application without saving the settings.
+        This may be called more than once. The application is started again on the next use of the experiment.
         """
-        self.automation.Dispose()
-        logger.info('Closed AddInProcess.exe')
+        if self._experiment is not None:
+            try:
+                self._experiment.ExperimentCompleted -= self._on_experiment_completed
+            except Exception as e:
+                logger.error(f"Error removing the ExperimentCompleted handler: {e}")
+        if self._finalizer is not None:
+            self._finalizer()
+        self._experiment = None
+        self._application = None
+        self._automation = None
+        self._finalizer = None
       
 
 _light_app = LightfieldApplicationManager()
@@ -170,10 +333,16 @@ class PrincetonSpectrometerConfig(SpectrometerConfig):
     def __init__(self, logger_level: int, experiment_name: str = None):
         super().__init__(logger_level)
         self._experiment_name = experiment_name
+        # the settings are named with the Lightfield assemblies, which are loaded here without starting Lightfield
+        _require_lightfield_assemblies()
 
     def open(self) -> None:
-        """ Opens the Lightfield application. """
-        self.light.initialize(True)
+        """
+        Opens the Lightfield application, unless it has already been started,
+        for example on first use of a setting.
+        """
+        if not self.light.is_initialized:
+            self.light.initialize(True)
 
     def close(self) -> None:
         """
@@ -181,20 +350,6 @@ class PrincetonSpectrometerConfig(SpectrometerConfig):
         """
         self.light.close()
 
-    def __del__(self) -> None:
-        """
-        Invoke this after object garbage collection occurs. 
-        This method cannot be placed in the LightfieldApplicationManager class anymore 
-        since 'automation' will be None before it can even be called 
-        and will return a 'TypeError: module object is not callable' error when you close the GUI.
-        Preventing you from running the HyperSpectral GUI again.
-        """
-        if self.light.automation is not None:
-            try:
-                self.light.automation.Dispose()
-            except Exception as e:
-                logger.error(f"Error disposing Lightfield automation: {e}")
-
     @property
     def experiment_name(self) -> Union[str, None]:
         """
@@ -271,7 +426,8 @@ class PrincetonSpectrometerConfig(SpectrometerConfig):
         there is not a current way to use the exact Lightfield settings
         for step and glue. Will have to interpolate for now.
         """
-        wavelength_array = np.fromiter(self.light.experiment.SystemColumnCalibration, np.float64)
+        calibration = self.light.experiment.SystemColumnCalibration
+        wavelength_array = _net_array_to_numpy(calibration, np.float64, calibration.Length)
         return wavelength_array
 
     @property
@@ -384,4 +540,5 @@ class PrincetonSpectrometerDataAcquisition(SpectrometerDataAcquisition):
         # Try click "Stop" on the GUI then "Start" again when you
         # take a scan and you will be able to replicate the error.
         self.light.stop_flag = True
-        self.light.experiment.Stop()
+        if self.light.is_initialized:  # there is nothing to stop if Lightfield has not been started
+            self.light.experiment.Stop()
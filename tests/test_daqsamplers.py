@@ -0,0 +1,285 @@
+import itertools
+import logging
+
+import numpy as np
+import pytest
+
+from qt3utils.datagenerators.daqsamplers import (
+    NiDaqDigitalInputRateCounter,
+    RandomRateCounter,
+    RateCounterBase,
+    _SPSCRing,
+)
+
+
+class RecordingRandomRateCounter(RandomRateCounter):
+    """
+    A RandomRateCounter that keeps a copy of every batch it returns, for computing the expected results.
+    """
+
+    def __init__(self, num_data_samples_per_batch):
+        super().__init__(num_data_samples_per_batch=num_data_samples_per_batch)
+        self.rng = np.random.default_rng(1234)
+        self.batches = []
+
+    def _read_samples(self):
+        data_sample, samples_read = super()._read_samples()
+        self.batches.append(np.array(data_sample[:samples_read]))
+        return data_sample, samples_read
+
+
+class ListRateCounter(RateCounterBase):
+    """
+    Returns the given batches in turn, which may be shorter than num_data_samples_per_batch.
+    """
+
+    def __init__(self, batches, num_data_samples_per_batch):
+        super().__init__()
+        self.clock_rate = 1000
+        self.num_data_samples_per_batch = num_data_samples_per_batch
+        self._batches = iter(batches)
+        self._buffer = np.zeros(num_data_samples_per_batch)
+
+    def _read_samples(self):
+        batch = next(self._batches)
+        self._buffer[:len(batch)] = batch
+        self._buffer[len(batch):] = -1  # values past samples_read must not be used
+        return self._buffer, len(batch)
+
+
+def baseline_batch_data(batches):
+    return np.array([[np.sum(batch), len(batch)] for batch in batches], dtype=float)
+
+
+def baseline_count_rate(data_counts, clock_rate):
+    data_counts = np.asarray(data_counts, dtype=float)
+    summed = data_counts.sum(axis=-2)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        rate = clock_rate * summed[..., 0] / summed[..., 1]
+    return np.where(summed[..., 1] > 0, rate, np.nan)
+
+
+@pytest.mark.parametrize('num_data_samples_per_batch', [1, 10])
+@pytest.mark.parametrize('n_batches', [1, 4])
+def test_sample_counts_matches_baseline(num_data_samples_per_batch, n_batches):
+    counter = RecordingRandomRateCounter(num_data_samples_per_batch)
+    counter.start()
+
+    data = counter.sample_counts(n_batches, sum_counts=False)
+    expected = baseline_batch_data(counter.batches)
+    np.testing.assert_allclose(data, expected, rtol=1e-6)
+
+    counter.batches = []
+    summed = counter.sample_counts(n_batches)
+    expected = baseline_batch_data(counter.batches).sum(axis=0, keepdims=True)
+    assert summed.shape == (1, 2)
+    np.testing.assert_allclose(summed, expected, rtol=1e-6)
+
+
+@pytest.mark.parametrize('num_data_samples_per_batch', [1, 4])
+def test_sample_counts_short_and_empty_batches(num_data_samples_per_batch):
+    batches = [[1.] * num_data_samples_per_batch, [], [2.] * (num_data_samples_per_batch - 1 or 1)]
+    counter = ListRateCounter(batches, num_data_samples_per_batch)
+    data = counter.sample_counts(len(batches), sum_counts=False)
+    np.testing.assert_array_equal(data, baseline_batch_data(batches))
+
+
+@pytest.mark.parametrize('num_data_samples_per_batch', [1, 10])
+def test_sample_counts_into_out(num_data_samples_per_batch):
+    counter = RecordingRandomRateCounter(num_data_samples_per_batch)
+    counter.start()
+    out = np.full((3, 2), np.nan)
+
+    data = counter.sample_counts(3, sum_counts=False, out=out)
+    assert data is out
+    np.testing.assert_allclose(out, baseline_batch_data(counter.batches), rtol=1e-6)
+
+    with pytest.raises(ValueError):
+        counter.sample_counts(2, sum_counts=False, out=out)
+
+
+@pytest.mark.parametrize('shape', [(6, 2), (5, 1, 2), (5, 3, 2), (2, 4, 3, 2)])
+def test_sample_count_rate_leading_dimensions(shape):
+    counter = RandomRateCounter()
+    counter.clock_rate = 1000
+    rng = np.random.default_rng(42)
+    data_counts = rng.integers(0, 100, size=shape).astype(float)
+    data_counts[..., 1] += 1
+    data_counts.reshape(-1, 2)[0, 1] = 0  # a batch without clock samples
+
+    rates = counter.sample_count_rate(data_counts)
+    expected = baseline_count_rate(data_counts, counter.clock_rate)
+    assert np.shape(rates) == shape[:-2]
+    np.testing.assert_allclose(rates, expected, equal_nan=True)
+
+
+def test_sample_count_rate_without_clock_samples():
+    counter = RandomRateCounter()
+    counter.clock_rate = 1000
+    assert np.isnan(counter.sample_count_rate(np.array([[50., 0.], [20., 0.]])))
+
+
+def test_sample_count_rate_single_row():
+    counter = RandomRateCounter()
+    counter.clock_rate = 1000
+    assert counter.sample_count_rate(np.array([[50., 10.]])) == pytest.approx(5000)
+    assert np.isnan(counter.sample_count_rate(np.array([[50., 0.]])))
+
+
+def test_sample_count_rate_line_without_clock_samples():
+    counter = RandomRateCounter()
+    counter.clock_rate = 1000
+    rates = counter.sample_count_rate(np.array([[[10., 0.]], [[10., 5.]]]))
+    np.testing.assert_allclose(rates, [np.nan, 2000], equal_nan=True)
+
+
+def test_yield_count_rate_matches_sample_count_rate():
+    batches = [[1., 2., 3.], [4., 5., 6.], [7., 8.]]
+    counter = ListRateCounter(batches, 3)
+    counter.start()
+    rates = list(itertools.islice(counter.yield_count_rate(), len(batches)))
+    expected = [counter.sample_count_rate(data) for data in baseline_batch_data(batches)[:, np.newaxis]]
+    np.testing.assert_allclose(rates, expected)
+
+
+def test_yield_count_rate_smoothing():
+    batches = [[10.], [20.], [], [40.], [50.]]
+    counter = ListRateCounter(batches, 1)
+    counter.start()
+    rates = list(itertools.islice(counter.yield_count_rate(smoothing_factor=0.25), len(batches)))
+
+    # the average restarts from the next batch rate after a batch without clock samples
+    expected = [10000., 0.25 * 20000 + 0.75 * 10000, np.nan, 40000., 0.25 * 50000 + 0.75 * 40000]
+    np.testing.assert_allclose(rates, expected, equal_nan=True)
+
+
+class StoppingRateCounter(ListRateCounter):
+    """
+    A ListRateCounter that stops once it has returned n_reads batches.
+    """
+
+    def __init__(self, batches, num_data_samples_per_batch, n_reads):
+        super().__init__(batches, num_data_samples_per_batch)
+        self.n_reads = n_reads
+
+    def _read_samples(self):
+        self.n_reads -= 1
+        if self.n_reads <= 0:
+            self.running = False
+        return super()._read_samples()
+
+
+def test_iter_count_rates_full_batches():
+    batches = [[float(i)] * 2 for i in range(6)]
+    counter = StoppingRateCounter(batches, 2, n_reads=6)
+    counter.start()
+    rate_batches = [rates.copy() for rates in counter.iter_count_rates(batch_size=3)]
+
+    assert [len(rates) for rates in rate_batches] == [3, 3]
+    np.testing.assert_allclose(np.concatenate(rate_batches), 1000 * np.arange(6))
+
+
+def test_iter_count_rates_partial_batch():
+    batches = [[float(i)] * 2 for i in range(5)]
+    counter = StoppingRateCounter(batches, 2, n_reads=5)
+    counter.start()
+    rate_batches = [rates.copy() for rates in counter.iter_count_rates(batch_size=3)]
+
+    # the rates read before the counter was stopped are yielded, and no empty array follows them
+    assert [len(rates) for rates in rate_batches] == [3, 2]
+    np.testing.assert_allclose(np.concatenate(rate_batches), 1000 * np.arange(5))
+
+
+class RacingRateCounter(ListRateCounter):
+    """
+    A ListRateCounter that is stopped right after the first check of running, before any batch is read.
+    """
+
+    @property
+    def running(self):
+        is_running = self._running
+        self._running = False
+        return is_running
+
+    @running.setter
+    def running(self, value):
+        self._running = value
+
+
+def test_iter_count_rates_stopped_before_a_read():
+    counter = RacingRateCounter([], 2)
+    counter.start()
+    assert list(counter.iter_count_rates(batch_size=3)) == []
+
+
+def test_ring_capacity_must_be_power_of_two():
+    with pytest.raises(ValueError):
+        _SPSCRing(3, 4)
+
+
+def test_ring_fifo_and_full():
+    ring = _SPSCRing(4, 3)
+    out = np.empty(3)
+    assert len(ring) == 0 and not ring.is_full()
+
+    for i in range(4):
+        ring.free_slot()[:] = i
+        ring.publish(3 - i % 2)
+    assert len(ring) == 4 and ring.is_full()
+
+    for i in range(4):
+        size = ring.pop_into(out)
+        assert size == 3 - i % 2
+        np.testing.assert_array_equal(out[:size], i)
+    assert len(ring) == 0 and not ring.is_full()
+
+
+def test_ring_pop_latest_discards_older_batches():
+    ring = _SPSCRing(4, 2)
+    out = np.empty(2)
+    for i in range(4):
+        ring.free_slot()[:] = i
+        ring.publish(2)
+
+    assert ring.pop_latest_into(out) == 2
+    np.testing.assert_array_equal(out, 3)
+    assert len(ring) == 0
+
+    # the ring wraps around after being emptied
+    for i in range(3):
+        ring.free_slot()[:] = 10 + i
+        ring.publish(1)
+    assert ring.pop_into(out) == 1 and out[0] == 10
+    assert ring.pop_latest_into(out) == 1 and out[0] == 12
+    assert len(ring) == 0
+
+
+class FakeTask:
+    def __init__(self):
+        self.closed = False
+
+    def stop(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+class FakeEdgeCounterConfig:
+    def __init__(self):
+        self.clock_task = FakeTask()
+        self.counter_task = FakeTask()
+
+
+def test_nidaq_stop_does_not_wait_forever_for_a_hung_read(caplog):
+    counter = NiDaqDigitalInputRateCounter(read_write_timeout=0)
+    counter.nidaq_config = FakeEdgeCounterConfig()
+    counter.running = True
+    counter._read_done.clear()  # a read that never completes
+
+    with caplog.at_level(logging.WARNING):
+        counter.stop()
+
+    assert not counter.running
+    assert counter.nidaq_config.clock_task.closed and counter.nidaq_config.counter_task.closed
+    assert 'did not complete' in caplog.text
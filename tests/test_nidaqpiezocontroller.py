@@ -0,0 +1,98 @@
+import gc
+
+import nidaqmx
+import nipiezojenapy
+import pytest
+
+from qt3utils.applications.controllers.nidaqpiezocontroller import PiezoWriteTasks
+
+
+class FakeTask:
+    """
+    Records the channel and the values written to an analog output task, instead of using hardware.
+    """
+    created = []
+
+    def __init__(self):
+        self.channel = None
+        self.writes = []
+        self.closed = False
+        self.ao_channels = self
+        FakeTask.created.append(self)
+
+    def add_ao_voltage_chan(self, channel):
+        self.channel = channel
+
+    def write(self, value):
+        self.writes.append(value)
+
+    def close(self):
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+@pytest.fixture
+def fake_task(monkeypatch):
+    FakeTask.created = []
+    monkeypatch.setattr(nidaqmx, 'Task', FakeTask)
+    return FakeTask
+
+
+def make_piezo_control():
+    return nipiezojenapy.PiezoControl('Dev1',
+                                      scale_microns_per_volt=(8, 4.2, 5),
+                                      zero_microns_volt_offset=(0, 1, 2.5),
+                                      move_settle_time=0)
+
+
+def test_write_matches_piezo_control(fake_task):
+    positions = [(0.0, 10.0, 20.0), (12.5, 33.3, 79.9)]
+
+    reference = make_piezo_control()
+    for x, y, z in positions:
+        reference.go_to_position(x, y, z)
+    reference_writes = {task.channel: [] for task in fake_task.created}
+    for task in fake_task.created:
+        reference_writes[task.channel] += task.writes
+
+    fake_task.created = []
+    piezo_control = make_piezo_control()
+    write_tasks = PiezoWriteTasks(piezo_control)
+    for position in positions:
+        for axis_index, value in enumerate(position):
+            write_tasks.write(axis_index, value)
+
+    assert len(fake_task.created) == 3  # one task per axis, reused for every move
+    assert {task.channel: task.writes for task in fake_task.created} == pytest.approx(reference_writes)
+    assert piezo_control.last_write_values == reference.last_write_values
+    assert piezo_control.get_current_position() == reference.get_current_position()
+
+
+def test_task_is_replaced_when_channel_changes(fake_task):
+    piezo_control = make_piezo_control()
+    write_tasks = PiezoWriteTasks(piezo_control)
+    write_tasks.write(0, 1.0)
+    piezo_control.write_channels = ['ao3', 'ao1', 'ao2']
+    write_tasks.write(0, 2.0)
+
+    assert [task.channel for task in fake_task.created] == ['Dev1/ao0', 'Dev1/ao3']
+    assert fake_task.created[0].closed
+    assert not fake_task.created[1].closed
+
+
+def test_close_and_finalize(fake_task):
+    write_tasks = PiezoWriteTasks(make_piezo_control())
+    write_tasks.write(0, 1.0)
+    write_tasks.close()
+    assert fake_task.created[0].closed
+
+    # tasks are created again after close, and closed when the object is garbage collected
+    write_tasks.write(1, 1.0)
+    del write_tasks
+    gc.collect()
+    assert all(task.closed for task in fake_task.created)
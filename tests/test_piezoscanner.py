@@ -0,0 +1,154 @@
+import numpy as np
+import pytest
+
+from qt3utils.datagenerators.daqsamplers import RateCounterBase
+from qt3utils.datagenerators.piezoscanner import CounterAndScanner, gauss, gauss_jac, scan_positions
+
+GAUSS_PARAMETERS = (1200., 3.5, 0.7, 80.)
+
+
+def baseline_gauss(x, C, mu, sigma, offset):
+    return C * np.exp(-(np.asarray(x) - mu) ** 2 / (2 * sigma ** 2)) + offset
+
+
+@pytest.mark.parametrize('min_val, max_val, step_size, expected_size', [
+    (0, 10, 1, 11),
+    (0, 10, 3, 4),
+    (0, 1.7, 0.1, 18),
+    (0.3, 0.9, 0.2, 4),
+    (-2, 2, 0.5, 9),
+    (5, 5, 0.5, 1),
+])
+def test_scan_positions(min_val, max_val, step_size, expected_size):
+    positions = scan_positions(min_val, max_val, step_size)
+    assert len(positions) == expected_size
+    assert positions[0] == min_val
+    assert positions.max() <= max_val
+    np.testing.assert_allclose(np.diff(positions), step_size)
+    np.testing.assert_allclose(positions, min_val + step_size * np.arange(expected_size))
+
+
+def test_scan_positions_endpoint_is_not_past_max():
+    # np.arange(0, 1.7 + 0.1, 0.1) ends at 1.7000000000000002
+    assert scan_positions(0, 1.7, 0.1)[-1] == 1.7
+
+
+def test_scan_positions_is_cached_and_read_only():
+    positions = scan_positions(0, 2, 0.25)
+    assert scan_positions(0, 2, 0.25) is positions
+    with pytest.raises(ValueError):
+        positions[0] = 1.
+
+
+def test_gauss_matches_baseline():
+    x = np.linspace(0, 7, 29)
+    np.testing.assert_allclose(gauss(x, *GAUSS_PARAMETERS), baseline_gauss(x, *GAUSS_PARAMETERS))
+    assert gauss(3.0, *GAUSS_PARAMETERS) == pytest.approx(baseline_gauss(3.0, *GAUSS_PARAMETERS))
+
+
+def test_gauss_does_not_modify_x():
+    x = np.linspace(0, 7, 29)
+    x_copy = x.copy()
+    gauss(x, *GAUSS_PARAMETERS)
+    np.testing.assert_array_equal(x, x_copy)
+
+
+def test_gauss_into_out():
+    x = np.linspace(0, 7, 29)
+    out = np.empty_like(x)
+    result = gauss(x, *GAUSS_PARAMETERS, out=out)
+    assert result is out
+    np.testing.assert_allclose(out, baseline_gauss(x, *GAUSS_PARAMETERS))
+
+
+def test_gauss_jac_matches_finite_differences():
+    x = np.linspace(0, 7, 29)
+    jac = gauss_jac(x, *GAUSS_PARAMETERS)
+    assert jac.shape == (len(x), 4)
+
+    p = np.array(GAUSS_PARAMETERS)
+    for i in range(4):
+        h = 1e-6 * max(abs(p[i]), 1.)
+        p_plus, p_minus = p.copy(), p.copy()
+        p_plus[i] += h
+        p_minus[i] -= h
+        numerical = (baseline_gauss(x, *p_plus) - baseline_gauss(x, *p_minus)) / (2 * h)
+        np.testing.assert_allclose(jac[:, i], numerical, rtol=1e-5, atol=1e-6 * GAUSS_PARAMETERS[0])
+
+
+class FakeStage:
+    """
+    Records the moves of a stage with an allowed range of 0 to 80 microns.
+    """
+    minimum_allowed_position = 0
+    maximum_allowed_position = 80
+
+    def __init__(self):
+        self.position = {'x': 0., 'y': 0., 'z': 0.}
+        self.moves = []
+
+    def check_allowed_position(self, *positions):
+        for position in positions:
+            if not self.minimum_allowed_position <= position <= self.maximum_allowed_position:
+                raise ValueError(f'{position} is out of range')
+
+    def go_to_position(self, **positions):
+        self.moves.append(positions)
+        self.position.update(positions)
+
+    def get_current_position(self):
+        return [self.position[axis] for axis in 'xyz']
+
+
+class PositionRateCounter(RateCounterBase):
+    """
+    Counts x + 100 * y at the current stage position in a single clock sample.
+    """
+
+    def __init__(self, stage):
+        super().__init__()
+        self.clock_rate = 1
+        self.num_data_samples_per_batch = 1
+        self.stage = stage
+
+    def _read_samples(self):
+        return np.array([self.stage.position['x'] + 100 * self.stage.position['y']]), 1
+
+
+def run_scan(scanner):
+    scanner.start()
+    scanner.set_to_starting_position()
+    while scanner.still_scanning():
+        scanner.scan_x()
+        scanner.move_y()
+    scanner.stop()
+
+
+def make_scanner(xmax, ymax, step_size):
+    stage = FakeStage()
+    scanner = CounterAndScanner(PositionRateCounter(stage), stage)
+    scanner.raster_line_pause = 0
+    scanner.step_size = step_size
+    scanner.set_scan_range(0, xmax, 0, ymax)
+    return scanner, stage
+
+
+def test_scan_is_serpentine_and_stored_in_x_order():
+    scanner, stage = make_scanner(xmax=2, ymax=2, step_size=1)
+    run_scan(scanner)
+
+    x_moves = [move['x'] for move in stage.moves if list(move) == ['x']]
+    assert x_moves == [0, 1, 2, 2, 1, 0, 0, 1, 2]
+    xs, ys = np.meshgrid(scan_positions(0, 2, 1), scan_positions(0, 2, 1))
+    np.testing.assert_allclose(scanner.scanned_count_rate, xs + 100 * ys)
+
+
+def test_move_y_counts_rows():
+    # adding 0.1 to y 17 times gives 1.7000000000000004, past ymax
+    scanner, stage = make_scanner(xmax=0.2, ymax=1.7, step_size=0.1)
+    run_scan(scanner)
+
+    y_moves = [move['y'] for move in stage.moves if list(move) == ['y']]
+    np.testing.assert_allclose(y_moves, scan_positions(0, 1.7, 0.1)[1:])
+    assert max(y_moves) <= 1.7
+    assert len(scanner.scanned_count_rate) == 18
@@ -0,0 +1,143 @@
+import logging
+import pickle
+
+import numpy as np
+import pytest
+
+from qt3utils.applications.qt3scan.controller import (
+    QT3ScanHyperSpectralApplicationController,
+    STANDARD_COUNT_AGGREGATION_METHODS,
+)
+from qt3utils.datagenerators.piezoscanner import scan_positions
+
+
+@pytest.mark.parametrize('dtype', [np.float64, np.float32, np.uint64])
+def test_count_aggregation_matches_numpy(dtype):
+    wavelengths = np.linspace(600, 700, 7)
+    data = np.random.default_rng(3).integers(0, 1000, size=(3, 4, 7)).astype(dtype)
+
+    sums = STANDARD_COUNT_AGGREGATION_METHODS['Counts-Sum'](wavelengths, data)
+    means = STANDARD_COUNT_AGGREGATION_METHODS['Counts-Mean'](wavelengths, data)
+    np.testing.assert_allclose(sums, np.sum(data, axis=-1), rtol=1e-6)
+    np.testing.assert_allclose(means, np.mean(data, axis=-1), rtol=1e-6)
+
+
+@pytest.mark.parametrize('method', ['Counts-Mean', 'Axes-Weighted-Mean'])
+def test_count_aggregation_of_empty_range_is_nan(method):
+    data = np.zeros((3, 4, 0))
+    result = STANDARD_COUNT_AGGREGATION_METHODS[method](np.zeros(0), data)
+    assert result.shape == (3, 4)
+    assert np.all(np.isnan(result))
+
+
+class FakePositionController:
+    """
+    Records the moves of a stage with an allowed range of 0 to 80 microns.
+    """
+    minimum_allowed_position = 0
+    maximum_allowed_position = 80
+    last_config_dict = {}
+
+    def __init__(self):
+        self.position = {'x': 0., 'y': 0., 'z': 0.}
+        self.moves = []
+
+    def check_allowed_position(self, *positions):
+        for position in positions:
+            if not self.minimum_allowed_position <= position <= self.maximum_allowed_position:
+                raise ValueError(f'{position} is out of range')
+
+    def go_to_position(self, **positions):
+        self.moves.append(positions)
+        self.position.update(positions)
+
+
+class PositionSpectrometer:
+    """
+    Returns a spectrum of three wavelengths whose counts encode the stage position, x + 100 * y.
+    """
+    clock_rate = 1
+    last_config_dict = {}
+
+    def __init__(self, position_controller):
+        self.position_controller = position_controller
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def sample_spectrum(self):
+        position = self.position_controller.position
+        return np.full(3, position['x'] + 100 * position['y']), np.array([600., 650., 700.])
+
+
+def make_hyperspectral_controller(xmax, ymax, step_size):
+    position_controller = FakePositionController()
+    controller = QT3ScanHyperSpectralApplicationController(
+        position_controller, PositionSpectrometer(position_controller), logging.ERROR)
+    controller.raster_line_pause = 0
+    controller.step_size = step_size
+    controller.set_scan_range(0, xmax, 0, ymax)
+    return controller, position_controller
+
+
+def run_scan(controller):
+    controller.start()
+    controller.set_to_starting_position()
+    while controller.still_scanning():
+        controller.scan_x()
+        controller.move_y()
+    controller.stop()
+
+
+def test_hyperspectral_scan_is_serpentine_and_stored_in_x_order():
+    controller, position_controller = make_hyperspectral_controller(xmax=2, ymax=2, step_size=1)
+    run_scan(controller)
+
+    x_moves = [move['x'] for move in position_controller.moves if list(move) == ['x']]
+    assert x_moves == [0, 1, 2, 2, 1, 0, 0, 1, 2]
+    xs, ys = np.meshgrid(scan_positions(0, 2, 1), scan_positions(0, 2, 1))
+    expected_spectra = np.repeat((xs + 100 * ys)[..., np.newaxis], 3, axis=-1)
+    np.testing.assert_allclose(controller.hyper_spectral_raw_data, expected_spectra)
+
+
+def test_hyperspectral_move_y_counts_rows():
+    # adding 0.1 to y 17 times gives 1.7000000000000004, past ymax
+    controller, position_controller = make_hyperspectral_controller(xmax=0.2, ymax=1.7, step_size=0.1)
+    run_scan(controller)
+
+    y_moves = [move['y'] for move in position_controller.moves if list(move) == ['y']]
+    np.testing.assert_allclose(y_moves, scan_positions(0, 1.7, 0.1)[1:])
+    assert max(y_moves) <= 1.7
+    assert len(controller.hyper_spectral_raw_data) == 18
+
+
+def test_pickle_save_in_background(tmp_path):
+    controller, _ = make_hyperspectral_controller(xmax=2, ymax=2, step_size=1)
+    run_scan(controller)
+    file_name = str(tmp_path / 'scan.pkl')
+
+    controller.save_scan(file_name)
+    assert controller.wait_for_save(timeout=10)
+    assert controller.data_saved_once
+
+    with open(file_name, 'rb') as f:
+        data = pickle.load(f)
+    np.testing.assert_array_equal(data['hyperspectral_image'], controller.hyper_spectral_raw_data)
+    np.testing.assert_array_equal(data['wavelengths'], controller.hyper_spectral_wavelengths)
+
+    saved_data = controller.hyper_spectral_raw_data.copy()
+    controller.reset()
+    controller.load_scan(file_name)
+    np.testing.assert_array_equal(controller.hyper_spectral_raw_data, saved_data)
+
+
+def test_failed_pickle_save_is_not_marked_saved(tmp_path):
+    controller, _ = make_hyperspectral_controller(xmax=2, ymax=2, step_size=1)
+    run_scan(controller)
+
+    controller.save_scan(str(tmp_path / 'missing_directory' / 'scan.pkl'))
+    assert controller.wait_for_save(timeout=10)
+    assert not controller.data_saved_once